@@ -0,0 +1,256 @@
+'''
+Load test for the posts API.
+
+Empties the database and seeds it with --posts rows, so every run starts
+from the same table whatever earlier runs wrote, then drives each scenario
+at --concurrency and prints latency percentiles, throughput and peak RSS as
+JSON:
+
+    DATABASE_URI=sqlite:///posts-bench.db python benchmarks/bench_api.py \
+        --posts 100000 --concurrency 8 --requests 2000 --output results.json
+
+Requests go through the Flask test client in this process unless --url
+points at a running server on the same database; restart it between runs so
+nothing it keeps in memory outlives the reseeding.  Peak RSS is then the
+load generator's own and is reported as client_peak_rss_kb.  Pass --compare with an earlier results file to
+print the change per scenario and exit non-zero when p95 latency regressed
+by more than --max-regression.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+os.environ.setdefault("CONFIG_PATH", "posts.config.BenchmarkConfig")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy
+from sqlalchemy import func, insert, inspect, select, text
+
+from posts import app
+from posts import migrations
+from posts import models
+from posts.database import engine
+
+WORDS = ['bells', 'whistles', 'lorem', 'ipsum', 'dolor', 'amet', 'python',
+         'flask', 'query', 'index', 'cache', 'stream', 'latency', 'commit']
+
+SCENARIOS = ['list', 'list_title', 'list_body', 'get', 'post', 'put']
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words))
+
+def clear(connection):
+    ''' delete every row and start the ids from 1 again '''
+    tables = models.Base.metadata.sorted_tables
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('TRUNCATE {} RESTART IDENTITY'.format(
+            ', '.join(table.name for table in tables))))
+        return
+    for table in reversed(tables):
+        connection.execute(table.delete())
+    if inspect(connection).has_table('sqlite_sequence'):
+        connection.execute(text('DELETE FROM sqlite_sequence'))
+
+def count_posts():
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(
+            models.Post.__table__)).scalar()
+
+def seed(count, chunk_size = 10000):
+    ''' replace the posts with count fresh rows, returning the highest id '''
+    migrations.upgrade(engine)
+    rng = random.Random(0)
+    with engine.begin() as connection:
+        clear(connection)
+        for start in range(0, count, chunk_size):
+            rows = [{'title': 'Post {} {}'.format(i, sentence(rng, 3)),
+                     'body': sentence(rng, 40)}
+                    for i in range(start, min(start + chunk_size, count))]
+            connection.execute(insert(models.Post.__table__), rows)
+    with engine.connect() as connection:
+        return connection.execute(select(func.max(models.Post.id))).scalar() or 0
+
+class InProcessClient(object):
+    ''' issue requests through the Flask test client, one per thread '''
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, path, data = None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = app.test_client()
+        response = self.local.client.open(path, method = method, data = data,
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')])
+        response.close()
+        return response.status_code
+
+class HTTPClient(object):
+    ''' issue requests to a running server '''
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, data = None):
+        request = Request(self.url + path, data = data and data.encode('utf-8'),
+            headers = {'Accept': 'application/json',
+                       'Content-Type': 'application/json'})
+        request.get_method = lambda: method
+        try:
+            response = urlopen(request)
+            response.read()
+            return response.getcode()
+        except HTTPError as error:
+            return error.code
+
+def scenario_request(name, rng, max_id):
+    ''' the method, path and body of one request in a scenario '''
+    if name == 'list':
+        # after_id must be a positive id
+        return 'GET', '/api/posts?limit=50&after_id={}'.format(
+            rng.randint(1, max(max_id - 50, 1))), None
+    if name == 'list_title':
+        return 'GET', '/api/posts?limit=50&title_like={}'.format(rng.choice(WORDS)), None
+    if name == 'list_body':
+        return 'GET', '/api/posts?limit=50&body_like={}'.format(rng.choice(WORDS)), None
+    if name == 'get':
+        return 'GET', '/api/posts/{}'.format(rng.randint(1, max_id)), None
+    data = json.dumps({'title': 'Benchmark {}'.format(sentence(rng, 2)),
+                       'body': sentence(rng, 40)})
+    if name == 'post':
+        return 'POST', '/api/posts', data
+    return 'PUT', '/api/posts/{}'.format(rng.randint(1, max_id)), data
+
+def percentile(values, fraction):
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def run_scenario(client, name, requests, concurrency, max_id):
+    rng = random.Random(name)
+    calls = [scenario_request(name, rng, max_id) for i in range(requests)]
+
+    def timed(call):
+        start = time.perf_counter()
+        status = client.request(*call)
+        return time.perf_counter() - start, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, calls))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, status in results)
+    statuses = Counter(status for latency, status in results)
+    return {
+        'requests': requests,
+        # a 4xx means the scenario isn't measuring what it was meant to
+        'errors': sum(count for status, count in statuses.items()
+                      if not 200 <= status < 300),
+        'statuses': dict((str(status), count) for status, count in sorted(statuses.items())),
+        'requests_per_second': round(requests / elapsed, 1),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3)
+        }
+    }
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, max_regression):
+    ''' print the p95 change per scenario; return False on a regression '''
+    ok = True
+    for name, result in sorted(results['scenarios'].items()):
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        old, new = before['latency_ms']['p95'], result['latency_ms']['p95']
+        change = (new - old) / old if old else 0.0
+        regressed = change > max_regression
+        ok = ok and not regressed
+        sys.stderr.write('{:<12} p95 {:>10.3f} -> {:>10.3f} ms ({:+.1%}){}\n'.format(
+            name, old, new, change, '  REGRESSION' if regressed else ''))
+    return ok
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--posts', type = int, default = 10000,
+                        help = 'rows to seed before running (default 10000)')
+    parser.add_argument('--requests', type = int, default = 1000,
+                        help = 'requests per scenario (default 1000)')
+    parser.add_argument('--concurrency', type = int, default = 4,
+                        help = 'concurrent clients (default 4)')
+    parser.add_argument('--scenarios', default = ','.join(SCENARIOS),
+                        help = 'comma separated subset of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--url', help = 'drive a running server instead')
+    parser.add_argument('--output', help = 'write the results here too')
+    parser.add_argument('--compare', help = 'results file to compare against')
+    parser.add_argument('--max-regression', type = float, default = 0.2,
+                        help = 'allowed p95 slowdown for --compare (default 0.2)')
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    seed_started = time.perf_counter()
+    max_id = seed(args.posts)
+    seed_seconds = time.perf_counter() - seed_started
+
+    client = HTTPClient(args.url) if args.url else InProcessClient()
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'database': engine.dialect.name,
+        # as seeded; posts_after_run includes those added by the post scenario
+        'posts': count_posts(),
+        'concurrency': args.concurrency,
+        'seed_seconds': round(seed_seconds, 3),
+        'scenarios': {}
+    }
+    for name in scenarios:
+        results['scenarios'][name] = run_scenario(client, name, args.requests,
+                                                  args.concurrency, max_id)
+    results['posts_after_run'] = count_posts()
+    # with --url the server's memory is in another process
+    results['client_peak_rss_kb' if args.url else 'peak_rss_kb'] = peak_rss_kb()
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,7 +7,7 @@ config_path = os.environ.get("CONFIG_PATH", "posts.config.DevelopmentConfig")
 app.config.from_object(config_path)
 
 from . import api
-
-from .database import Base, engine
-Base.metadata.create_all(engine)
+from . import migrations
+from . import backup
+from . import changes
 
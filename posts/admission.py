@@ -0,0 +1,205 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque, OrderedDict
+
+from flask import g, request, Response
+
+from posts import app
+from .serializers import dumps
+
+# Admission control for the posts routes, applied with decorators.admit.
+# Excess load is turned away up front with a cheap response instead of
+# queueing on the database:
+#
+#   * each client has a token bucket refilled at RATE_LIMIT requests per
+#     second and holding up to RATE_LIMIT_BURST; an empty bucket gets a 429
+#   * at most MAX_CONCURRENT_REQUESTS requests run at once in a process; up
+#     to ADMISSION_QUEUE_SIZE more wait ADMISSION_TIMEOUT seconds for a slot
+#     and the rest get a 503 straight away
+#
+# Async views wait on a future of their event loop, which release() hands
+# the slot to, so a queued request doesn't tie up an executor thread.
+#
+# Both answers carry Retry-After.
+
+class LocalBuckets(object):
+    ''' token buckets kept in this process, for the busiest clients '''
+    def __init__(self, max_clients = 10000):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from a client's bucket.  Returns whether there was one
+        and, if not, how many seconds until there will be.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            tokens, stamp = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last = False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+class RedisBuckets(object):
+    ''' token buckets shared by every process, updated atomically in Redis '''
+    script = '''
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+        local tokens = tonumber(bucket[1]) or burst
+        local stamp = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring((1 - tokens) / rate)}
+    '''
+
+    def __init__(self, client, prefix = 'posts:ratelimit:'):
+        self.prefix = prefix
+        self.take_script = client.register_script(self.script)
+
+    def take(self, key, rate, burst):
+        allowed, wait = self.take_script(keys = [self.prefix + key],
+                                         args = [rate, burst, time.time()])
+        return bool(allowed), 0 if allowed else float(wait)
+
+def make_buckets(config):
+    ''' the token bucket store named by RATE_LIMIT_BACKEND '''
+    if config["RATE_LIMIT_BACKEND"] == 'redis':
+        import redis
+        return RedisBuckets(redis.Redis.from_url(config["RATE_LIMIT_URL"]))
+    if config["RATE_LIMIT_BACKEND"] == 'local':
+        return LocalBuckets()
+    raise ValueError('Unknown rate limit backend {}'.format(config["RATE_LIMIT_BACKEND"]))
+
+class ConcurrencyLimit(object):
+    ''' a cap on running requests, with a bounded number of waiters '''
+    def __init__(self, limit, queue_size):
+        self.slots = threading.BoundedSemaphore(limit) if limit else None
+        self.queue_size = queue_size
+        self.waiting = 0
+        self.lock = threading.Lock()
+        # (event loop, future) of each waiting async request
+        self.waiters = deque()
+
+    def acquire(self, timeout):
+        if self.slots is None or self.slots.acquire(blocking = False):
+            return True
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout = timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    async def acquire_async(self, timeout):
+        ''' acquire, waiting on the running event loop rather than a thread '''
+        if self.slots is None or self.slots.acquire(blocking = False):
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                return False
+            # a slot may have come free since, with no waiter to take it
+            if self.slots.acquire(blocking = False):
+                return True
+            self.waiting += 1
+            self.waiters.append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # the slot may have been handed over just as time ran out
+            return future.done() and not future.cancelled()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+
+    def hand_over(self, future):
+        ''' give a released slot to a waiting async request, on its loop '''
+        if future.done():
+            # it gave up waiting, so the slot goes to the next in line
+            self.release()
+        else:
+            future.set_result(True)
+
+    def release(self):
+        if self.slots is None:
+            return
+        with self.lock:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self.hand_over, future)
+                    return
+                except RuntimeError:
+                    # its event loop has closed
+                    continue
+        self.slots.release()
+
+buckets = make_buckets(app.config)
+concurrency = ConcurrencyLimit(app.config["MAX_CONCURRENT_REQUESTS"],
+                               app.config["ADMISSION_QUEUE_SIZE"])
+
+def rejected(message, status, retry_after):
+    data = dumps({'message': message})
+    headers = {'Retry-After': str(max(1, int(math.ceil(retry_after))))}
+    return Response(data, status, headers = headers, mimetype = 'application/json')
+
+def rate_limited():
+    ''' a 429 response if the client is over its rate limit, otherwise None '''
+    rate = app.config["RATE_LIMIT"]
+    if not rate:
+        return None
+    allowed, wait = buckets.take(request.remote_addr or '', rate,
+                                 app.config["RATE_LIMIT_BURST"])
+    if allowed:
+        return None
+    return rejected('Rate limit exceeded', 429, wait)
+
+def acquire():
+    ''' wait for a slot to run the request in; False if none came free '''
+    return concurrency.acquire(app.config["ADMISSION_TIMEOUT"])
+
+async def acquire_async():
+    ''' acquire, for async views '''
+    return await concurrency.acquire_async(app.config["ADMISSION_TIMEOUT"])
+
+def admitted():
+    ''' note the request holds a slot, released once its response is done '''
+    g.admission_slot = True
+
+def busy_response():
+    return rejected('The server is too busy, please try again', 503, 1)
+
+def release():
+    ''' give up the request's slot early, before waiting on something slow '''
+    if g.pop('admission_slot', False):
+        concurrency.release()
+
+@app.teardown_request
+def release_slot(exception = None):
+    # streamed responses keep the request open until the stream ends
+    release()
@@ -1,82 +1,543 @@
+import datetime
+import hashlib
 import json
+import queue
+from collections import namedtuple
 
-from flask import request, Response, url_for
-from jsonschema import validate, ValidationError
+from flask import request, Response, url_for, stream_with_context
+from jsonschema import ValidationError, validators, exceptions
+from sqlalchemy import func, select, insert, update, delete
+from sqlalchemy.orm import load_only
 
 from . import models
+from . import admission
 from . import decorators
+from . import coalesce
+from . import search
 from posts import app
+from . import database
 from .database import session
+from . import signals
+from . import metrics
+from . import snapshot
+from . import writebehind
+from .cache import post_cache, CachedPost
+from .serializers import dumps, dumps_items, loads
+
+# the length limits mirror the columns so oversized posts are rejected
+# before they reach the database
+title_length = models.Post.title.type.length
+body_length = models.Post.body.type.length
 
 post_schema = {
+    'type': 'object',
     'properties': {
         'title': {
-            'type': 'string'
+            'type': 'string',
+            'maxLength': title_length
         },
         'body': {
-            'type': 'string'
+            'type': 'string',
+            'maxLength': body_length
         }
     },
     'required': ['title', 'body']
 }
 
+# checked and compiled once at import rather than on every request
+post_validator_class = validators.validator_for(post_schema)
+post_validator_class.check_schema(post_schema)
+post_validator = post_validator_class(post_schema)
+
+def validate_post(data):
+    '''
+    Raise a ValidationError if data is not a valid post.  Well-formed posts
+    take a fast path; anything else goes through the full validator, which
+    picks the same error jsonschema.validate would report.
+    '''
+    if (isinstance(data, dict) and
+            isinstance(data.get('title'), str) and
+            isinstance(data.get('body'), str) and
+            len(data['title']) <= title_length and
+            len(data['body']) <= body_length):
+        return
+    error = exceptions.best_match(post_validator.iter_errors(data))
+    if error is not None:
+        raise error
+
+# PATCH takes any of the fields a post can change, but at least one
+post_patch_schema = {
+    'type': 'object',
+    'properties': post_schema['properties'],
+    'anyOf': [{'required': ['title']}, {'required': ['body']}]
+}
+post_validator_class.check_schema(post_patch_schema)
+post_patch_validator = post_validator_class(post_patch_schema)
+
+def validate_post_patch(data):
+    ''' Raise a ValidationError if data is not a valid partial post '''
+    error = exceptions.best_match(post_patch_validator.iter_errors(data))
+    if error is None:
+        return
+    # the anyOf failing says nothing about which fields were expected
+    if isinstance(data, dict) and not data.keys() & post_schema['properties'].keys():
+        raise ValidationError('A patch must change \'title\' or \'body\'')
+    raise error
+
+def patch_values(data):
+    ''' the columns a valid PATCH body changes '''
+    return dict((field, data[field]) for field in ('title', 'body') if field in data)
+
+post_fields = ('id', 'title', 'body')
+
+bulk_ops = ('create', 'update', 'delete')
+
+def error_response(message, status):
+    ''' build a JSON error response with a helpful message '''
+    data = dumps({'message': message})
+    return Response(data, status, mimetype = 'application/json')
+
+def positive_int_arg(name):
+    '''
+    Read an optional positive integer from the querystring.  Returns None when
+    the argument is absent and raises ValueError when it is malformed.
+    '''
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError('{} must be a positive integer'.format(name))
+    return int(value)
+
+def fields_arg():
+    '''
+    The post fields requested with ?fields=, or None for all of them.
+    Raises ValueError for unknown fields.
+    '''
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    for field in fields:
+        if field not in post_fields:
+            raise ValueError('Unknown field {}'.format(field))
+    if not fields:
+        raise ValueError('fields must name at least one field')
+    return fields
+
+def post_etag(id, version):
+    return '{}-{}'.format(id, version)
+
+def parse_post_etags(id, etags):
+    ''' the versions of post id named by a set of entity tags '''
+    versions = []
+    for etag in etags:
+        post_id, _, version = decorators.view_etag(etag).partition('-')
+        if post_id == str(id) and version.isdigit():
+            versions.append(int(version))
+    return versions
+
+def listing_etag(fields, count, id_sum, version_sum, last_modified):
+    '''
+    Entity tag for a list of posts.  Inserts and deletes change the count or
+    the id sum and every update bumps a version, so any change to the listed
+    rows gives a new tag.  Each projection is a separate representation.
+    
+    Listings are validated by this tag alone.  Their newest updated_at stays
+    the same when a post is deleted, so it can't serve as Last-Modified.
+    '''
+    if last_modified is not None:
+        last_modified = last_modified.isoformat()
+    validators = (fields, count, id_sum or 0, version_sum or 0, last_modified)
+    return hashlib.sha1(repr(validators).encode('ascii')).hexdigest()
+
+def not_modified(etag, last_modified):
+    '''
+    Return a 304 Not Modified response if the client's copy is still current
+    according to If-None-Match or If-Modified-Since, otherwise None.
+    '''
+    if request.if_none_match:
+        # the client may hold any representation of the view's response
+        etags = request.if_none_match.as_set(include_weak = True)
+        current = (request.if_none_match.star_tag or
+                   etag in map(decorators.view_etag, etags))
+    elif request.if_modified_since and last_modified is not None:
+        last_modified = last_modified.replace(microsecond = 0,
+                                              tzinfo = datetime.timezone.utc)
+        current = last_modified <= request.if_modified_since
+    else:
+        current = False
+    if not current:
+        return None
+    response = Response(status = 304)
+    return with_validators(response, etag, last_modified)
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo = datetime.timezone.utc)
+    return response
+
+def serialize(post):
+    ''' the bytes served for a single post '''
+    with metrics.timed('serialize'):
+        return dumps(post.as_dictionary())
+
+def stream_posts(statement, fields):
+    '''
+    Generate a JSON array of posts in chunks.  Rows are pulled from a
+    server-side cursor so memory use does not grow with the result size.
+    '''
+    separator = b'['
+    for posts in session.scalars(statement).partitions():
+        yield separator + dumps_items([post.as_dictionary(fields) for post in posts])
+        separator = b','
+    # an empty result never wrote the opening bracket
+    yield b'[]' if separator == b'[' else b']'
+
+# a parsed listing request: the statement selecting the matching posts, the
+# same statement before pagination, and the options which shape the response
+Listing = namedtuple('Listing', 'statement filtered limit fields stream count')
+
+count_modes = ('only', 'estimate')
+
+def filter_posts(statement):
+    ''' apply the title_like, body_like and q filters in the querystring '''
+    title_like = request.args.get('title_like')
+    body_like = request.args.get('body_like')
+    q = request.args.get('q')
+    if title_like:
+        statement = search.filter_contains(statement, models.Post.title, title_like)
+    if body_like:
+        statement = search.filter_contains(statement, models.Post.body, body_like)
+    if q:
+        statement = search.filter_tokens(statement, q)
+    return statement
+
+def ids_arg():
+    '''
+    The comma separated post ids in ?ids=, or None when absent.  Raises
+    ValueError when they are malformed.
+    '''
+    value = request.args.get('ids')
+    if value is None:
+        return None
+    ids = [id.strip() for id in value.split(',') if id.strip()]
+    if not ids or not all(id.isdigit() for id in ids):
+        raise ValueError('ids must be a comma separated list of post ids')
+    return [int(id) for id in ids]
+
+def listing_from_request():
+    '''
+    Parse the listing querystring into a select statement for the matching
+    posts.  Raises ValueError for malformed arguments.
+    '''
+    # get the querystring arguments
+    stream = request.args.get('stream') in ('1', 'true')
+    limit = positive_int_arg('limit')
+    after_id = positive_int_arg('after_id')
+    fields = fields_arg()
+    count = request.args.get('count')
+    if limit is not None:
+        limit = min(limit, app.config['MAX_PAGE_SIZE'])
+    if count is not None and count not in count_modes:
+        raise ValueError('count must be one of {}'.format(', '.join(count_modes)))
+    # HEAD only ever reports the count
+    if request.method == 'HEAD' and count is None:
+        count = 'only'
+    
+    # filter the posts
+    statement = filter_posts(select(models.Post))
+    filtered = statement
+    # keyset pagination: continue after the last id the client has seen
+    if after_id:
+        statement = statement.filter(models.Post.id > after_id)
+    statement = statement.order_by(models.Post.id)
+    # only select the requested columns, plus the validators
+    if fields:
+        columns = [getattr(models.Post, field) for field in fields]
+        statement = statement.options(load_only(models.Post.version,
+                                                models.Post.updated_at, *columns))
+    return Listing(statement, filtered, limit, fields, stream, count)
+
+def listing_count_statement(listing):
+    ''' SELECT count(*) of the posts matching the listing's filters '''
+    return listing.filtered.with_only_columns(func.count(),
+                                              maintain_column_froms = True)
+
+def listing_explain_statement(listing, dialect):
+    '''
+    The SQL and parameters asking the Postgres planner how many posts match
+    the listing's filters, for ?count=estimate.  Planning reads the table
+    statistics rather than the rows, so it costs the same for any table size.
+    The parameters are in the driver's own form, for exec_driver_sql: a
+    tuple for positional drivers such as asyncpg, otherwise a dictionary.
+    '''
+    statement = listing.filtered.with_only_columns(models.Post.id)
+    compiled = statement.compile(dialect = dialect,
+                                 compile_kwargs = {'render_postcompile': True})
+    parameters = compiled.params
+    if dialect.positional:
+        parameters = tuple(parameters[key] for key in compiled.positiontup)
+    return 'EXPLAIN (FORMAT JSON) ' + str(compiled), parameters
+
+def planned_rows(plan):
+    ''' the row estimate from the output of listing_explain_statement '''
+    if isinstance(plan, str):
+        plan = loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def uses_estimates(listing, dialect):
+    ''' only Postgres keeps the statistics behind ?count=estimate '''
+    return listing.count == 'estimate' and dialect.name == 'postgresql'
+
+def count_response(count, estimated):
+    ''' the response for a HEAD or ?count= listing request '''
+    headers = {'X-Total-Count': str(count)}
+    if request.method == 'HEAD':
+        return Response(b'', 200, headers = headers, mimetype = 'application/json')
+    data = {'count': count}
+    if estimated:
+        data['estimated'] = True
+    return Response(dumps(data), 200, headers = headers, mimetype = 'application/json')
+
+def listing_stream_statement(listing):
+    ''' the statement for a streamed listing, read from a server-side cursor '''
+    statement = listing.statement
+    if listing.limit is not None:
+        statement = statement.limit(listing.limit)
+    return statement.execution_options(yield_per = app.config['STREAM_CHUNK_SIZE'])
+
+def listing_validators_statement(listing):
+    '''
+    An aggregate over the listed rows giving the arguments of listing_etag,
+    so conditional requests can be answered without loading the rows.
+    '''
+    page = listing.statement
+    if listing.limit is not None:
+        page = page.limit(listing.limit)
+    page = page.subquery()
+    return select(func.count(), func.sum(page.c.id), func.sum(page.c.version),
+                  func.max(page.c.updated_at))
+
+def listing_page_statement(listing):
+    ''' fetch one extra row so we know whether there is a next page '''
+    if listing.limit is None:
+        return listing.statement
+    return listing.statement.limit(listing.limit + 1)
+
+# a serialized page of a listing, with its headers and entity tag
+ListingPage = namedtuple('ListingPage', 'data headers etag')
+
+def listing_page(listing, posts):
+    ''' serialize the posts loaded by listing_page_statement '''
+    headers = {}
+    if listing.limit is not None and len(posts) > listing.limit:
+        posts = posts[:listing.limit]
+        args = request.args.to_dict()
+        args['after_id'] = posts[-1].id
+        args['limit'] = listing.limit
+        next_url = url_for('posts_get', **args)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    
+    # convert the posts to JSON
+    with metrics.timed('serialize'):
+        data = dumps([post.as_dictionary(listing.fields) for post in posts])
+    last_modified = max([post.updated_at for post in posts] or [None])
+    etag = listing_etag(listing.fields, len(posts), sum(post.id for post in posts),
+                        sum(post.version for post in posts), last_modified)
+    return ListingPage(data, headers, etag)
+
+def listing_page_response(page):
+    response = Response(page.data, 200, headers = page.headers,
+                        mimetype = 'application/json')
+    return with_validators(response, page.etag, None)
+
+def listing_response(listing, posts):
+    ''' build the response for the posts loaded by listing_page_statement '''
+    return listing_page_response(listing_page(listing, posts))
+
+def coalesced(key, func):
+    '''
+    Call func once for concurrent requests with the same key, handing each
+    of them the result.  Reads from a replica may be behind the primary, so
+    they are never shared with clients reading their own writes.
+    '''
+    if not app.config['COALESCE_READS']:
+        return func()
+    value, shared = coalesce.reads.do(key + (database.uses_replica(),), func)
+    if shared:
+        metrics.coalesced_requests.inc(metrics.route())
+    return value
+
+def snapshot_response(listed):
+    ''' serve the unfiltered listing from the bytes and tag in the snapshot '''
+    data, etag = listed
+    response = not_modified(etag, None)
+    if response:
+        return response
+    response = Response(data, 200, mimetype = 'application/json')
+    return with_validators(response, etag, None)
+
 @app.route('/api/posts', methods=['GET'])
+@decorators.admit
 @decorators.accept('application/json')
+@database.read_only
 def posts_get():
     ''' get a list of posts '''
-    # get the querystring arguments
-    title_like = request.args.get('title_like')
-    body_like = request.args.get('body_like')
+    try:
+        listing = listing_from_request()
+    except ValueError as error:
+        return error_response(str(error), 400)
     
-    # get and filter the posts from the database
-    posts = session.query(models.Post)
-    if title_like:
-        posts = posts.filter(models.Post.title.contains(title_like))
-    if body_like:
-        posts = posts.filter(models.Post.body.contains(body_like))
-    posts = posts.order_by(models.Post.id)
+    # count the matches in the database without loading any rows
+    if listing.count:
+        connection = session.connection()
+        if uses_estimates(listing, connection.dialect):
+            sql, parameters = listing_explain_statement(listing, connection.dialect)
+            plan = connection.exec_driver_sql(sql, parameters).scalar()
+            return count_response(planned_rows(plan), True)
+        count = session.execute(listing_count_statement(listing)).scalar()
+        return count_response(count, False)
     
-    # convert the posts to JSON and return a response
-    data = json.dumps([post.as_dictionary() for post in posts])
-    return Response(data, 200, mimetype = 'application/json')
+    if listing.stream:
+        statement = listing_stream_statement(listing)
+        generator = stream_with_context(stream_posts(statement, listing.fields))
+        return Response(generator, 200, mimetype = 'application/json')
+    
+    # the unfiltered listing is kept pre-serialized; reads sent to a replica
+    # stay there
+    if snapshot.usable() and not database.uses_replica():
+        with metrics.timed('serialize'):
+            listed = snapshot.listing.get()
+        if listed is not None:
+            return snapshot_response(listed)
+    
+    # answer conditional requests from an aggregate over the rows, without
+    # loading or serializing them
+    if request.if_none_match:
+        validators = session.execute(listing_validators_statement(listing)).one()
+        response = not_modified(listing_etag(listing.fields, *validators), None)
+        if response:
+            return response
+    
+    # get the posts from the database; identical listings requested at the
+    # same time share one query
+    def load():
+        posts = session.scalars(listing_page_statement(listing)).all()
+        return listing_page(listing, posts)
+    key = ('posts_get',) + tuple(sorted(request.args.items(multi = True)))
+    return listing_page_response(coalesced(key, load))
+    
+def cache_post(post, token):
+    '''
+    Serialize a post into the cache, returning the new entry.  token is the
+    cache token taken before the post was read.
+    '''
+    entry = CachedPost(post.version, post.updated_at, serialize(post))
+    # a replica may not have seen the latest write yet, so what it returned
+    # is only kept for as long as replicas are allowed to lag
+    ttl = app.config['REPLICA_LAG_SECONDS'] if database.uses_replica() else None
+    post_cache.fill(post.id, entry, token, ttl)
+    return entry
+
+def post_response(id, entry):
+    ''' the response for a cached post, or a 304 if the client's copy is current '''
+    etag = post_etag(id, entry.version)
+    response = not_modified(etag, entry.updated_at)
+    if response:
+        return response
     
+    # return the post as JSON
+    response = Response(entry.data, 200, mimetype = 'application/json')
+    return with_validators(response, etag, entry.updated_at)
+
 @app.route('/api/posts/<int:id>', methods=['GET'])
+@decorators.admit
 @decorators.accept('application/json')
+@database.read_only
 def post_get(id):
     ''' single post endpoint '''
-    # get the post from the database
-    post = session.query(models.Post).get(id)
-    
-    # check whether the post exists
-    # if not return a 404 with a helpful message
-    if not post:
-        message = 'Could not find post with id {}'.format(id)
-        data = json.dumps({'message': message})
-        return Response(data, 404, mimetype = 'application/json')
+    # hot posts are served straight from the cache
+    entry = post_cache.get(id)
+    if entry is None:
+        # get the post from the database, once for all the requests
+        # missing the cache at the same time
+        def load():
+            token = post_cache.token(id)
+            post = session.get(models.Post, id)
+            return cache_post(post, token) if post else None
+        entry = coalesced(('post_get', id), load)
         
-    # return the post as JSON
-    data = json.dumps(post.as_dictionary())
+        # check whether the post exists
+        # if not return a 404 with a helpful message
+        if entry is None:
+            message = 'Could not find post with id {}'.format(id)
+            data = dumps({'message': message})
+            return Response(data, 404, mimetype = 'application/json')
+    
+    return post_response(id, entry)
+
+@app.route('/api/cache', methods=['GET'])
+@decorators.accept('application/json')
+def cache_get():
+    ''' post cache hit and miss counters '''
+    data = dumps(post_cache.stats())
     return Response(data, 200, mimetype = 'application/json')
 
 @app.route('/api/posts/<int:id>', methods=['DELETE'])
+@decorators.admit
 @decorators.accept('application/json')
 def post_delete(id):
     ''' delete post '''
-    # get the post from the database
-    post = session.query(models.Post).get(id)
-    if not post:
+    # delete in one statement; RETURNING tells us whether the post existed
+    statement = delete(models.Post).where(models.Post.id == id).returning(
+        models.Post.id)
+    deleted = session.execute(statement).first()
+    if deleted is None:
+        session.rollback()
         message = 'Post with id {} requested for deletion does not exist.'.format(id)
-        data = json.dumps({'message': message})
+        data = dumps({'message': message})
         return Response(data, 404, mimetype = 'application/json')
     
-    session.delete(post)
+    signals.stage_post_changes(session, deleted = [id])
     session.commit()
     
     message = 'Successfully deleted post with id {}'.format(id)
-    data = json.dumps({'message': message})
+    data = dumps({'message': message})
     return Response(data, 200, mimetype = 'application/json')
+
+@app.route('/api/posts', methods=['DELETE'])
+@decorators.admit
+@decorators.accept('application/json')
+def posts_delete():
+    ''' delete every post matching ?ids=, title_like, body_like or q '''
+    try:
+        ids = ids_arg()
+    except ValueError as error:
+        return error_response(str(error), 400)
+    filters = ('title_like', 'body_like', 'q')
+    if ids is None and not any(request.args.get(name) for name in filters):
+        message = 'Deleting posts needs ids, title_like, body_like or q'
+        return error_response(message, 400)
+    if ids is not None and len(ids) > app.config['BULK_MAX_ITEMS']:
+        message = 'Bulk deletes are limited to {} ids'.format(app.config['BULK_MAX_ITEMS'])
+        return error_response(message, 413)
+    
+    # one DELETE in the database, however many posts match
+    statement = filter_posts(select(models.Post))
+    if ids is not None:
+        statement = statement.where(models.Post.id.in_(ids))
+    statement = delete(models.Post).where(statement.whereclause).returning(
+        models.Post.id).execution_options(synchronize_session = False)
+    deleted = session.scalars(statement).all()
+    signals.stage_post_changes(session, deleted = deleted)
+    session.commit()
+    
+    return Response(dumps({'deleted': len(deleted)}), 200, mimetype = 'application/json')
     
 @app.route('/api/posts', methods = ['POST'])
+@decorators.admit
 @decorators.accept('application/json')
 @decorators.require('application/json')
 def posts_post():
@@ -86,10 +547,23 @@ def posts_post():
     # check that the JSON supplied is valid
     # if not you return a 422 Unprocessable Entity
     try:
-        validate(data, post_schema)
+        validate_post(data)
     except ValidationError as error:
         data = {'message': error.message}
-        return Response(json.dumps(data), 422, mimetype = 'application/json')
+        return Response(dumps(data), 422, mimetype = 'application/json')
+    
+    # with write-behind on, the post goes out in the next group commit
+    if writebehind.enabled():
+        try:
+            pending = writebehind.write_queue.submit(data['title'], data['body'])
+        except queue.Full:
+            return writebehind.queue_full_response()
+        if writebehind.respond_async():
+            return writebehind.accepted_response(pending)
+        # waiting for the group commit doesn't need one of the request slots
+        admission.release()
+        pending.wait(app.config['WRITE_WAIT_TIMEOUT'])
+        return writebehind.created_response(pending)
     
     # add the post to the database
     post = models.Post(title = data['title'], body = data['body'])
@@ -98,11 +572,12 @@ def posts_post():
     
     # return a 201 Created, containing the post as JSON and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
+    data = dumps(post.as_dictionary())
     headers = {'Location': url_for('post_get', id = post.id)}
     return Response(data, 201, headers = headers, mimetype = 'application/json')
     
 @app.route('/api/posts/<int:id>', methods = ['PUT'])
+@decorators.admit
 @decorators.accept('application/json')
 @decorators.require('application/json')
 def posts_put(id):
@@ -112,26 +587,183 @@ def posts_put(id):
     # check that the JSON supplied is valid
     # if not you return a 422 Unprocessable Entity
     try:
-        validate(data, post_schema)
+        validate_post(data)
     except ValidationError as error:
         data = {'message': error.message}
-        return Response(json.dumps(data), 422, mimetype = 'application/json')
+        return Response(dumps(data), 422, mimetype = 'application/json')
     
-    # retrieve the post and return error if it does not exist
-    post = session.query(models.Post).get(id)
+    return update_post(id, {'title': data['title'], 'body': data['body']})
+
+@app.route('/api/posts/<int:id>', methods = ['PATCH'])
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/json')
+def posts_patch(id):
+    ''' change some of the fields of an existing post '''
+    data = request.json
+    try:
+        validate_post_patch(data)
+    except ValidationError as error:
+        return error_response(error.message, 422)
     
-    if not post:
-        message = 'Could not find post with id {}'.format(id)
-        data = json.dumps({'message': message})
-        return Response(data, 404, mimetype = 'application/json')
-        
-    # update the post
-    post.title = data['title']
-    post.body = data['body']
-    session.commit()
+    return update_post(id, patch_values(data))
+
+def update_statement(id, values):
+    '''
+    A single UPDATE of the given columns of a post, returning the whole row.
+    With If-Match it only applies to a version the client last saw.
+    '''
+    statement = update(models.Post).where(models.Post.id == id)
+    if request.if_match and not request.if_match.star_tag:
+        versions = parse_post_etags(id, request.if_match.as_set())
+        statement = statement.where(models.Post.version.in_(versions))
+    return statement.values(**values).returning(models.Post.id, models.Post.title,
+        models.Post.body, models.Post.version, models.Post.updated_at)
+
+def update_failed(id, exists):
+    ''' the response when update_statement matched no row '''
+    if exists:
+        message = 'Post with id {} has been modified since it was read'.format(id)
+        return error_response(message, 412)
+    return error_response('Could not find post with id {}'.format(id), 404)
+
+def updated_post(row):
+    ''' the post returned by update_statement, as a dictionary '''
+    return {'id': row.id, 'title': row.title, 'body': row.body}
+
+def updated_response(row):
+    ''' the response for a post changed by update_statement '''
+    post = updated_post(row)
     
     # return a 200 OK, containing the post as JSON and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {'Location': url_for('post_get', id = post.id)}
-    return Response(data, 200, headers = headers, mimetype = 'application/json')
\ No newline at end of file
+    data = dumps(post)
+    headers = {'Location': url_for('post_get', id = row.id)}
+    response = Response(data, 200, headers = headers, mimetype = 'application/json')
+    return with_validators(response, post_etag(row.id, row.version), row.updated_at)
+
+def update_post(id, values):
+    ''' update a post in one round-trip, without reading it first '''
+    row = session.execute(update_statement(id, values)).first()
+    if row is None:
+        session.rollback()
+        # only a conditional update needs to tell 404 from 412
+        conditional = request.if_match and not request.if_match.star_tag
+        return update_failed(id, conditional and session.get(models.Post, id) is not None)
+    signals.stage_post_changes(session, updated = [updated_post(row)])
+    session.commit()
+    return updated_response(row)
+
+def read_bulk_items():
+    '''
+    The items of a bulk request, sent either as a JSON array or as NDJSON
+    with one item per line.  Raises ValueError for malformed bodies.
+    '''
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        lines = request.get_data(as_text = True).splitlines()
+        for number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    items.append(loads(line))
+                except ValueError:
+                    raise ValueError('Line {} is not valid JSON'.format(number))
+        return items
+    items = request.get_json(silent = True)
+    if not isinstance(items, list):
+        raise ValueError('Bulk requests must contain a JSON array')
+    return items
+
+def bulk_item_error(item):
+    ''' the validation message for a bulk item, or None if it is valid '''
+    if not isinstance(item, dict):
+        return 'Item must be a JSON object'
+    op = item.get('op', 'create')
+    if op not in bulk_ops:
+        return '{} is not one of {}'.format(json.dumps(op), ', '.join(bulk_ops))
+    if op != 'create':
+        id = item.get('id')
+        if not isinstance(id, int) or isinstance(id, bool):
+            return '\'id\' must be an integer'
+    if op != 'delete':
+        try:
+            validate_post(item)
+        except ValidationError as error:
+            return error.message
+    return None
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+@app.route('/api/posts/_bulk', methods = ['POST'])
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/json', 'application/x-ndjson')
+def posts_bulk():
+    ''' create, update and delete many posts in one transaction '''
+    try:
+        items = read_bulk_items()
+    except ValueError as error:
+        return error_response(str(error), 400)
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        message = 'Bulk requests are limited to {} items'.format(
+            app.config['BULK_MAX_ITEMS'])
+        return error_response(message, 413)
+    
+    # the whole batch is validated before anything is written; a single
+    # invalid item rejects the batch with a message for each bad item
+    errors = [bulk_item_error(item) for item in items]
+    if any(errors):
+        results = [{'status': 422, 'message': error} if error else {'status': None}
+                   for error in errors]
+        return Response(dumps(results), 422, mimetype = 'application/json')
+    
+    results = [None] * len(items)
+    operations = dict((op, []) for op in bulk_ops)
+    for index, item in enumerate(items):
+        operations[item.get('op', 'create')].append((index, item))
+    chunk_size = app.config['BULK_CHUNK_SIZE']
+    created, updated, deleted = [], [], []
+    
+    # inserts go out as executemany batches, returning the new ids in order
+    statement = insert(models.Post).returning(models.Post.id,
+                                              sort_by_parameter_order = True)
+    for chunk in chunked(operations['create'], chunk_size):
+        rows = [{'title': item['title'], 'body': item['body']} for index, item in chunk]
+        ids = session.scalars(statement, rows).all()
+        for (index, item), id, row in zip(chunk, ids, rows):
+            row['id'] = id
+            created.append(row)
+            results[index] = {'status': 201, 'id': id}
+    
+    # updates by primary key, skipping (and reporting) ids which don't exist
+    for chunk in chunked(operations['update'], chunk_size):
+        ids = [item['id'] for index, item in chunk]
+        existing = set(session.scalars(
+            select(models.Post.id).where(models.Post.id.in_(ids))))
+        rows = []
+        for index, item in chunk:
+            if item['id'] in existing:
+                rows.append({'id': item['id'], 'title': item['title'],
+                             'body': item['body']})
+                results[index] = {'status': 200, 'id': item['id']}
+            else:
+                results[index] = {'status': 404, 'id': item['id']}
+        if rows:
+            session.execute(update(models.Post), rows)
+            updated.extend(rows)
+    
+    for chunk in chunked(operations['delete'], chunk_size):
+        ids = [item['id'] for index, item in chunk]
+        statement = delete(models.Post).where(models.Post.id.in_(ids)).returning(
+            models.Post.id)
+        removed = set(session.scalars(statement))
+        deleted.extend(removed)
+        for index, item in chunk:
+            status = 200 if item['id'] in removed else 404
+            results[index] = {'status': status, 'id': item['id']}
+    
+    signals.stage_post_changes(session, created, updated, deleted)
+    session.commit()
+    return Response(dumps(results), 200, mimetype = 'application/json')
@@ -0,0 +1,453 @@
+import asyncio
+import inspect
+import io
+import queue
+import sys
+
+from flask import request, Response, url_for
+from jsonschema import ValidationError
+from sqlalchemy import delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.exceptions import HTTPException
+
+from . import admission
+from . import api
+from . import changes
+from . import decorators
+from . import metrics
+from . import models
+from . import signals
+from . import snapshot
+from . import writebehind
+from posts import app
+from .cache import post_cache
+from .database import Session, engine_options
+from .serializers import dumps, dumps_items
+
+# An ASGI entry point serving the posts API from an event loop, e.g.
+#
+#     uvicorn posts.asgi:application
+#
+# The endpoints below are async versions of the views in posts.api which talk
+# to the database through SQLAlchemy's asyncio engine, so one process can keep
+# many database-bound requests in flight.  They are wrapped in the same
+# decorators and share the request parsing and response building of the
+# sync views.  Any other route is handed to the WSGI app on a worker thread,
+# which reads the request body and sends the response a chunk at a time, so
+# exports and imports never have to fit in memory.
+
+async_drivers = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite'
+}
+
+def async_database_uri(config):
+    ''' ASYNC_DATABASE_URI, or DATABASE_URI with the matching async driver '''
+    if config.get("ASYNC_DATABASE_URI"):
+        return config["ASYNC_DATABASE_URI"]
+    url = make_url(config["DATABASE_URI"])
+    backend = url.get_backend_name()
+    drivername = '{}+{}'.format(backend, async_drivers[backend])
+    return url.set(drivername = drivername).render_as_string(hide_password = False)
+
+async_engine = create_async_engine(async_database_uri(app.config),
+                                   **engine_options(app.config))
+# sessions share the sync Session class so writes still announce themselves
+# through signals.posts_changed
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit = False,
+                                  sync_session_class = Session.class_)
+metrics.instrument(async_engine.sync_engine)
+
+views = {}
+
+def view(endpoint):
+    ''' register an async implementation of a posts.api endpoint '''
+    def decorator(func):
+        views[endpoint] = func
+        return func
+    return decorator
+
+async def stream_posts(statement, fields):
+    ''' async version of api.stream_posts '''
+    separator = b'['
+    async with AsyncSession() as session:
+        result = await session.stream_scalars(statement)
+        async for posts in result.partitions():
+            yield separator + dumps_items([post.as_dictionary(fields) for post in posts])
+            separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+@view('posts_get')
+@decorators.admit
+@decorators.accept('application/json')
+async def posts_get():
+    ''' get a list of posts '''
+    try:
+        listing = api.listing_from_request()
+    except ValueError as error:
+        return api.error_response(str(error), 400)
+
+    if listing.count:
+        async with AsyncSession() as session:
+            connection = await session.connection()
+            if api.uses_estimates(listing, connection.dialect):
+                sql, parameters = api.listing_explain_statement(listing,
+                                                                connection.dialect)
+                plan = (await connection.exec_driver_sql(sql, parameters)).scalar()
+                return api.count_response(api.planned_rows(plan), True)
+            count = (await session.execute(api.listing_count_statement(listing))).scalar()
+        return api.count_response(count, False)
+
+    if listing.stream:
+        statement = api.listing_stream_statement(listing)
+        generator = stream_posts(statement, listing.fields)
+        return Response(generator, 200, mimetype = 'application/json')
+
+    # a stale snapshot is rebuilt with the sync engine, off the event loop
+    if snapshot.usable():
+        if snapshot.listing.fresh():
+            listed = snapshot.listing.get()
+        else:
+            listed = await asyncio.to_thread(snapshot.listing.get)
+        if listed is not None:
+            return api.snapshot_response(listed)
+
+    async with AsyncSession() as session:
+        if request.if_none_match:
+            statement = api.listing_validators_statement(listing)
+            validators = (await session.execute(statement)).one()
+            response = api.not_modified(api.listing_etag(listing.fields, *validators),
+                                        None)
+            if response:
+                return response
+
+        statement = api.listing_page_statement(listing)
+        posts = (await session.scalars(statement)).all()
+    return api.listing_response(listing, posts)
+
+@view('post_get')
+@decorators.admit
+@decorators.accept('application/json')
+async def post_get(id):
+    ''' single post endpoint '''
+    entry = post_cache.get(id)
+    if entry is None:
+        token = post_cache.token(id)
+        async with AsyncSession() as session:
+            post = await session.get(models.Post, id)
+        if not post:
+            message = 'Could not find post with id {}'.format(id)
+            return api.error_response(message, 404)
+
+        response = api.not_modified(api.post_etag(id, post.version), post.updated_at)
+        if response:
+            return response
+        entry = api.cache_post(post, token)
+
+    return api.post_response(id, entry)
+
+@view('post_delete')
+@decorators.admit
+@decorators.accept('application/json')
+async def post_delete(id):
+    ''' delete post '''
+    statement = delete(models.Post).where(models.Post.id == id).returning(
+        models.Post.id)
+    async with AsyncSession() as session:
+        deleted = (await session.execute(statement)).first()
+        if deleted is not None:
+            signals.stage_post_changes(session, deleted = [id])
+        await session.commit()
+    if deleted is None:
+        message = 'Post with id {} requested for deletion does not exist.'.format(id)
+        return api.error_response(message, 404)
+
+    message = 'Successfully deleted post with id {}'.format(id)
+    return Response(dumps({'message': message}), 200, mimetype = 'application/json')
+
+@view('posts_post')
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/json')
+async def posts_post():
+    ''' add a new post '''
+    data = request.json
+    try:
+        api.validate_post(data)
+    except ValidationError as error:
+        return api.error_response(error.message, 422)
+
+    if writebehind.enabled():
+        try:
+            pending = writebehind.write_queue.submit(data['title'], data['body'])
+        except queue.Full:
+            return writebehind.queue_full_response()
+        if writebehind.respond_async():
+            return writebehind.accepted_response(pending)
+        # wait for the group commit without a request slot or blocking the
+        # event loop
+        admission.release()
+        await asyncio.to_thread(pending.wait, app.config['WRITE_WAIT_TIMEOUT'])
+        return writebehind.created_response(pending)
+
+    post = models.Post(title = data['title'], body = data['body'])
+    async with AsyncSession() as session:
+        session.add(post)
+        await session.commit()
+
+    data = dumps(post.as_dictionary())
+    headers = {'Location': url_for('post_get', id = post.id)}
+    return Response(data, 201, headers = headers, mimetype = 'application/json')
+
+async def update_post(id, values):
+    ''' async version of api.update_post '''
+    async with AsyncSession() as session:
+        row = (await session.execute(api.update_statement(id, values))).first()
+        if row is None:
+            await session.rollback()
+            conditional = request.if_match and not request.if_match.star_tag
+            exists = conditional and await session.get(models.Post, id) is not None
+            return api.update_failed(id, exists)
+        signals.stage_post_changes(session, updated = [api.updated_post(row)])
+        await session.commit()
+    return api.updated_response(row)
+
+@view('posts_put')
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/json')
+async def posts_put(id):
+    ''' update an existing post, in one UPDATE ... RETURNING statement '''
+    data = request.json
+    try:
+        api.validate_post(data)
+    except ValidationError as error:
+        return api.error_response(error.message, 422)
+
+    return await update_post(id, {'title': data['title'], 'body': data['body']})
+
+@view('posts_patch')
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/json')
+async def posts_patch(id):
+    ''' change some of the fields of an existing post '''
+    data = request.json
+    try:
+        api.validate_post_patch(data)
+    except ValidationError as error:
+        return api.error_response(error.message, 422)
+
+    return await update_post(id, api.patch_values(data))
+
+async def wait_for_changes(since, limit, timeout):
+    ''' async version of changes.wait_for_changes '''
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        generation = changes.notifier.generation
+        async with async_engine.connect() as connection:
+            found = await connection.run_sync(changes.read_changes, since, limit)
+        remaining = deadline - asyncio.get_running_loop().time()
+        if found or remaining <= 0:
+            return found
+        await changes.notifier.wait_async(
+            generation, min(remaining, app.config['CHANGES_POLL_INTERVAL']))
+
+async def stream_changes(since, limit):
+    ''' async version of changes.stream_changes '''
+    while True:
+        found = await wait_for_changes(since, limit, app.config['CHANGES_KEEPALIVE'])
+        if found:
+            since = found[-1]['seq']
+            yield changes.format_events(found)
+        else:
+            yield changes.KEEPALIVE
+
+@view('posts_changes')
+@decorators.admit
+@decorators.accept('application/json', 'text/event-stream')
+async def posts_changes():
+    ''' the changes to posts after ?since=, as JSON or server-sent events '''
+    try:
+        since, limit, wait = changes.changes_args()
+    except ValueError as error:
+        return api.error_response(str(error), 400)
+    async with async_engine.connect() as connection:
+        if await connection.run_sync(changes.is_gone, since):
+            return changes.gone_response(since)
+
+    if changes.wants_event_stream():
+        admission.release()
+        return Response(stream_changes(since, limit), 200,
+                        mimetype = 'text/event-stream',
+                        headers = {'Cache-Control': 'no-cache'})
+    if wait:
+        admission.release()
+    found = await wait_for_changes(since, limit, wait)
+    return Response(dumps(found), 200, mimetype = 'application/json')
+
+def wsgi_environ(scope):
+    '''
+    A WSGI environ for an ASGI http scope.  The caller supplies wsgi.input
+    and, when it has read the whole body, CONTENT_LENGTH.
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+class ReceiveStream(io.RawIOBase):
+    '''
+    The request body as a file, for the WSGI app on a worker thread.  Each
+    read waits for the next message from the event loop, so the body is
+    never held in memory all at once.
+    '''
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.chunk = memoryview(b'')
+        self.more = True
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while not self.chunk and self.more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise OSError('Client disconnected')
+            self.chunk = memoryview(message.get('body', b''))
+            self.more = message.get('more_body', False)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+def call_wsgi(environ, send, loop):
+    '''
+    Run the WSGI app on a worker thread, sending its response on the event
+    loop as it is produced.  Each chunk waits for the one before it to be
+    sent, so a slow client holds the app back rather than filling memory.
+    '''
+    def send_sync(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+    
+    started = []
+    def start_response(status, headers, exc_info = None):
+        started[:] = [int(status.split(' ', 1)[0]), headers, False]
+    
+    def send_start():
+        status, headers, sent = started
+        if not sent:
+            started[2] = True
+            send_sync({'type': 'http.response.start', 'status': status,
+                       'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]})
+    
+    iterable = app.wsgi_app(environ, start_response)
+    try:
+        for chunk in iterable:
+            if chunk:
+                send_start()
+                send_sync({'type': 'http.response.body', 'body': chunk,
+                           'more_body': True})
+        send_start()
+        send_sync({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_response(send, response, environ):
+    headers = [(name.encode('latin-1'), value.encode('latin-1'))
+               for name, value in response.get_wsgi_headers(environ).to_wsgi_list()]
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': headers})
+    body = response.response
+    if hasattr(body, '__aiter__'):
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': True})
+    else:
+        for chunk in response.iter_encoded():
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.to_thread(snapshot.preload)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    environ = wsgi_environ(scope)
+    try:
+        endpoint, view_args = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        endpoint = None
+
+    if endpoint not in views:
+        loop = asyncio.get_running_loop()
+        environ['wsgi.input'] = io.BufferedReader(ReceiveStream(receive, loop))
+        # a body without Content-Length is read until it ends
+        environ['wsgi.input_terminated'] = True
+        await asyncio.to_thread(call_wsgi, environ, send, loop)
+        return
+
+    # the async views parse their bodies whole
+    body = await read_body(receive)
+    environ['wsgi.input'] = io.BytesIO(body)
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    with app.request_context(environ):
+        # run the app's request hooks around the view, as Flask would
+        try:
+            response = app.preprocess_request()
+            if response is None:
+                response = views[endpoint](**view_args)
+                if inspect.isawaitable(response):
+                    response = await response
+        except HTTPException as error:
+            response = app.handle_http_exception(error)
+        response = app.process_response(app.make_response(response))
+        await send_response(send, response, environ)
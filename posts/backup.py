@@ -0,0 +1,208 @@
+import csv
+import datetime
+import gzip
+import io
+
+import click
+from flask import request, Response, stream_with_context
+from jsonschema import ValidationError
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+from . import api
+from . import changes
+from . import compression
+from . import database
+from . import decorators
+from . import models
+from . import search
+from . import snapshot
+from posts import app
+from .database import engine, session
+from .serializers import dumps, loads
+
+# Streaming NDJSON export and import of the posts table, one post per line:
+#
+#     flask --app posts export --gzip posts.ndjson.gz
+#     flask --app posts import posts.ndjson.gz
+#
+# or over HTTP with GET /api/posts/_export and POST /api/posts/_import.
+# Both directions work a chunk of rows at a time, so memory use does not
+# grow with the size of the table.
+
+columns = ('id', 'title', 'body', 'version', 'updated_at')
+
+def export_posts(connection, chunk_size):
+    ''' generate NDJSON for every post in id order, a chunk of rows at a time '''
+    table = models.Post.__table__
+    statement = select(*[table.c[column] for column in columns]).order_by(
+        table.c.id).execution_options(yield_per = chunk_size)
+    for rows in connection.execute(statement).partitions():
+        lines = []
+        for row in rows:
+            post = row._asdict()
+            post['updated_at'] = post['updated_at'].isoformat()
+            lines.append(dumps(post))
+        yield b'\n'.join(lines) + b'\n'
+
+def parse_timestamp(value):
+    ''' a naive UTC timestamp from an ISO 8601 string, or now if there is none '''
+    if value is None:
+        return models.utcnow()
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo = None)
+    return timestamp
+
+def read_posts(lines):
+    ''' parse and validate NDJSON lines, raising ValueError for bad ones '''
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            post = loads(line)
+        except ValueError:
+            raise ValueError('Line {} is not valid JSON'.format(number))
+        if not isinstance(post, dict):
+            raise ValueError('Line {}: post must be a JSON object'.format(number))
+        id = post.get('id')
+        if not isinstance(id, int) or isinstance(id, bool) or id < 1:
+            raise ValueError('Line {}: \'id\' must be a positive integer'.format(number))
+        try:
+            api.validate_post(post)
+        except ValidationError as error:
+            raise ValueError('Line {}: {}'.format(number, error.message))
+        version = post.get('version', 1)
+        if not isinstance(version, int) or isinstance(version, bool) or version < 1:
+            raise ValueError('Line {}: \'version\' must be a positive integer'.format(number))
+        try:
+            updated_at = parse_timestamp(post.get('updated_at'))
+        except (TypeError, ValueError):
+            raise ValueError('Line {}: \'updated_at\' must be an ISO 8601 timestamp'.format(number))
+        yield {'id': id, 'title': post['title'], 'body': post['body'],
+               'version': version, 'updated_at': updated_at}
+
+def copy_rows(connection, rows):
+    ''' load rows with COPY, the fastest way into Postgres '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting = csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow([row['id'], row['title'], row['body'], row['version'],
+                         row['updated_at'].isoformat()])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY posts ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+def import_posts(connection, posts, chunk_size):
+    '''
+    Insert posts from read_posts in chunks, with COPY on psycopg2 and
+    executemany elsewhere.  Returns the number of posts imported; the caller
+    owns the transaction.
+    '''
+    statement = insert(models.Post.__table__)
+    def write(chunk):
+        if connection.dialect.driver == 'psycopg2':
+            copy_rows(connection, chunk)
+        else:
+            connection.execute(statement, chunk)
+        # clients following the change log see imported posts as new
+        changes.record(connection, created = chunk)
+    
+    count = 0
+    chunk = []
+    for post in posts:
+        chunk.append(post)
+        if len(chunk) == chunk_size:
+            write(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        write(chunk)
+        count += len(chunk)
+    if connection.dialect.name == 'postgresql':
+        # the ids were given, so move the sequence past them
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('posts', 'id'), "
+                                "max(id)) FROM posts"))
+    return count
+
+def imported():
+    '''
+    The in-process search index and listing snapshot have to be rebuilt to
+    see imported posts
+    '''
+    search.index.reset()
+    snapshot.listing.reset()
+
+@app.route('/api/posts/_export', methods = ['GET'])
+@decorators.admit
+@decorators.accept('application/x-ndjson')
+@database.read_only
+def posts_export():
+    ''' stream every post as NDJSON '''
+    # the rows are read while the response streams, not in the view
+    def generate():
+        yield from export_posts(session.connection(), app.config['STREAM_CHUNK_SIZE'])
+    
+    # accept compresses the stream for clients which take gzip
+    return Response(stream_with_context(generate()), 200,
+                    mimetype = 'application/x-ndjson')
+
+@app.route('/api/posts/_import', methods = ['POST'])
+@decorators.admit
+@decorators.accept('application/json')
+@decorators.require('application/x-ndjson')
+def posts_import():
+    ''' load posts from an NDJSON upload, gzipped with Content-Encoding: gzip '''
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    if encoding not in ('identity', 'gzip'):
+        message = 'Unsupported Content-Encoding {}'.format(encoding)
+        return api.error_response(message, 415)
+    lines = request.stream
+    if encoding == 'gzip':
+        lines = gzip.GzipFile(fileobj = request.stream)
+
+    try:
+        count = import_posts(session.connection(), read_posts(lines),
+                             app.config['BULK_CHUNK_SIZE'])
+    except (ValueError, OSError, EOFError) as error:
+        session.rollback()
+        return api.error_response(str(error), 422)
+    except (IntegrityError, engine.dialect.dbapi.IntegrityError):
+        session.rollback()
+        return api.error_response('Some of the imported ids already exist', 409)
+    session.commit()
+    imported()
+    return Response(dumps({'imported': count}), 200, mimetype = 'application/json')
+
+@app.cli.command('export')
+@click.argument('output', type = click.File('wb'), default = '-')
+@click.option('--gzip', 'compress', is_flag = True, help = 'gzip the output')
+def export_command(output, compress):
+    ''' write every post to OUTPUT as NDJSON '''
+    with engine.connect() as connection:
+        chunks = export_posts(connection, app.config['STREAM_CHUNK_SIZE'])
+        if compress:
+            chunks = compression.compress_stream(chunks, 'gzip')
+        for chunk in chunks:
+            output.write(chunk)
+
+@app.cli.command('import')
+@click.argument('input', type = click.File('rb'), default = '-')
+def import_command(input):
+    ''' load posts from NDJSON in INPUT, which may be gzipped '''
+    if input.peek(2)[:2] == b'\x1f\x8b':
+        input = gzip.GzipFile(fileobj = input)
+    try:
+        with engine.begin() as connection:
+            count = import_posts(connection, read_posts(input),
+                                 app.config['BULK_CHUNK_SIZE'])
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    except (IntegrityError, engine.dialect.dbapi.IntegrityError):
+        raise click.ClickException('Some of the imported ids already exist')
+    imported()
+    click.echo('Imported {} posts'.format(count), err = True)
@@ -0,0 +1,169 @@
+import datetime
+import fnmatch
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+
+from . import models
+from . import signals
+from posts import app
+
+class LocalBackend(object):
+    '''
+    In-process LRU store with per-key expiry.  It speaks the small subset of
+    the Redis client API the cache needs, so a redis.Redis instance can be
+    swapped in without changing PostCache.
+    '''
+    def __init__(self, max_entries = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value, ex = None):
+        expires = time.monotonic() + ex if ex else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+        return True
+    
+    def delete(self, *keys):
+        with self.lock:
+            return len([key for key in keys
+                        if self.entries.pop(key, None) is not None])
+    
+    def scan_iter(self, match = '*'):
+        with self.lock:
+            keys = list(self.entries)
+        return (key for key in keys if fnmatch.fnmatchcase(key, match))
+
+def make_backend(config):
+    ''' create the cache backend named by CACHE_BACKEND '''
+    if config["CACHE_BACKEND"] == 'redis':
+        # optional dependency, only needed when the cache is shared
+        import redis
+        return redis.Redis.from_url(config["CACHE_URL"])
+    if config["CACHE_BACKEND"] == 'local':
+        return LocalBackend(config["CACHE_MAX_ENTRIES"])
+    raise ValueError('Unknown cache backend {}'.format(config["CACHE_BACKEND"]))
+
+# a serialized post together with the validators for conditional requests
+CachedPost = namedtuple('CachedPost', 'version updated_at data')
+
+class PostCache(object):
+    '''
+    Read-through cache of serialized posts, keyed by post id.
+    
+    A read which misses takes a token for the post before querying the
+    database, and stores what it read with fill, which checks the token.
+    Writes invalidate the post, which changes its token before the entry is
+    dropped, so a read which started before the write can't put the old
+    post back once the write has removed it.
+    '''
+    # how long an invalidation is remembered; longer than a read takes
+    invalidation_ttl = 60
+    
+    def __init__(self, backend, ttl = None, prefix = 'posts:post:'):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, id):
+        return '{}{}'.format(self.prefix, id)
+    
+    def token_key(self, id):
+        return '{}{}:token'.format(self.prefix, id)
+    
+    def get(self, id):
+        ''' the CachedPost for a post, or None on a miss '''
+        value = self.backend.get(self.key(id))
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            return None
+        # the validators sit on a header line in front of the JSON
+        header, data = value.split(b'\n', 1)
+        version, updated_at = header.decode('ascii').split(' ')
+        updated_at = datetime.datetime.strptime(updated_at, '%Y-%m-%dT%H:%M:%S.%f')
+        return CachedPost(int(version), updated_at, data)
+    
+    def set(self, id, entry, ttl = None):
+        header = '{} {}\n'.format(entry.version,
+                                  entry.updated_at.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        value = header.encode('ascii') + entry.data
+        self.backend.set(self.key(id), value, ex = ttl or self.ttl)
+    
+    def token(self, id):
+        ''' taken before reading a post from the database, and passed to fill '''
+        return self.backend.get(self.token_key(id))
+    
+    def fill(self, id, entry, token, ttl = None):
+        '''
+        Store an entry read after taking token, unless the post has been
+        invalidated since.  An invalidation may come in between the check
+        and the set, so the token is checked again after storing: either
+        that sees the new token, or the invalidation deletes the entry after
+        it was stored.  Returns whether the entry was kept.
+        '''
+        if self.token(id) != token:
+            return False
+        self.set(id, entry, ttl)
+        if self.token(id) != token:
+            self.delete(id)
+            return False
+        return True
+    
+    def invalidate(self, *ids):
+        ''' drop posts, and stop reads already under way from storing them '''
+        for id in ids:
+            self.backend.set(self.token_key(id), uuid.uuid4().hex,
+                             ex = self.invalidation_ttl)
+        self.delete(*ids)
+    
+    def delete(self, *ids):
+        if ids:
+            self.backend.delete(*[self.key(id) for id in ids])
+    
+    def clear(self):
+        keys = list(self.backend.scan_iter(self.prefix + '*'))
+        if keys:
+            self.backend.delete(*keys)
+    
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+post_cache = PostCache(make_backend(app.config), app.config["CACHE_TTL"])
+
+@signals.posts_changed.connect
+def update_cache(sender, created = (), updated = (), deleted = ()):
+    # entries are dropped rather than rewritten, so concurrent writers don't
+    # race to store theirs; created ids may be reused ones
+    ids = [post['id'] for post in list(created) + list(updated)]
+    post_cache.invalidate(*(ids + list(deleted)))
+
+# the cached rows are gone once the table is recreated or dropped
+event.listen(models.Post.__table__, 'after_create', lambda *args, **kw: post_cache.clear())
+event.listen(models.Post.__table__, 'after_drop', lambda *args, **kw: post_cache.clear())
@@ -0,0 +1,232 @@
+import asyncio
+import datetime
+import threading
+import time
+
+import click
+from flask import request, Response, stream_with_context
+from sqlalchemy import delete, event, func, insert, select, text
+
+from . import admission
+from . import api
+from . import decorators
+from . import models
+from . import signals
+from posts import app
+from .database import engine, Session
+from .serializers import dumps
+
+# A change log for clients which keep a copy of the posts, so they can sync
+# incrementally instead of polling GET /api/posts:
+#
+#     GET /api/posts/changes?since=<seq>
+#
+# Every transaction which changes posts appends an entry per post to the
+# post_changes table before it commits, numbered by an increasing sequence.
+# Clients ask for the entries after the last one they have seen, either
+# waiting up to ?wait= seconds for one to turn up (long-polling) or with
+# Accept: text/event-stream to have them pushed as server-sent events.
+#
+# Waiting requests are woken by commits in this process and otherwise check
+# the database every CHANGES_POLL_INTERVAL seconds, for writes made by other
+# processes.  Entries older than CHANGES_RETENTION seconds are removed by
+#
+#     flask --app posts prune-changes
+#
+# after which clients that were further behind get a 410 Gone and have to
+# reload the listing.
+
+change_log = models.PostChange.__table__
+
+# held by writers on Postgres from appending to the log until they commit,
+# so sequence numbers become visible in order and readers never skip one
+CHANGE_LOG_LOCK = 0x706f737473
+
+def record(connection, created = (), updated = (), deleted = ()):
+    ''' append changes to the log, in the transaction of connection '''
+    rows = [{'post_id': post['id'], 'op': op, 'title': post['title'],
+             'body': post['body']}
+            for op, posts in (('create', created), ('update', updated))
+            for post in posts]
+    rows.extend({'post_id': id, 'op': 'delete', 'title': None, 'body': None}
+                for id in deleted)
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {'key': CHANGE_LOG_LOCK})
+    connection.execute(insert(change_log), rows)
+
+@event.listens_for(Session, 'before_commit')
+def log_post_changes(session):
+    # pending ORM changes are only collected once they are flushed
+    session.flush()
+    changes = session.info.get('post_changes')
+    if changes:
+        created, updated, deleted = changes
+        record(session.connection(), created.values(), updated.values(),
+               sorted(deleted))
+
+class ChangeNotifier(object):
+    ''' wakes requests waiting for changes when this process commits some '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        # (event loop, asyncio.Event) for each waiting async request
+        self.async_waiters = set()
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+            waiters = list(self.async_waiters)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def wait(self, generation, timeout):
+        ''' wait until a commit after generation, or timeout seconds '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+
+    async def wait_async(self, generation, timeout):
+        ''' wait, without blocking the event loop '''
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            if self.generation != generation:
+                return
+            self.async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+
+notifier = ChangeNotifier()
+
+@signals.posts_changed.connect
+def wake_waiters(sender, **changes):
+    notifier.notify()
+
+def read_changes(connection, since, limit):
+    ''' up to limit changes after since, oldest first '''
+    statement = (select(change_log).where(change_log.c.seq > since)
+                 .order_by(change_log.c.seq).limit(limit))
+    return [models.PostChange(**row._asdict()).as_dictionary()
+            for row in connection.execute(statement)]
+
+def is_gone(connection, since):
+    '''
+    Whether changes after since have been pruned.  Pruning always keeps the
+    newest entry, so a gap before the oldest one means entries are missing.
+    '''
+    if not since:
+        return False
+    oldest = connection.execute(select(func.min(change_log.c.seq))).scalar()
+    return oldest is not None and since < oldest - 1
+
+def changes_args():
+    '''
+    The since, limit and wait arguments of a changes request.  An event
+    stream resumes from Last-Event-ID.  Raises ValueError when malformed.
+    '''
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    if not since.isdigit():
+        raise ValueError('since must be a change sequence number')
+    limit = api.positive_int_arg('limit') or app.config['CHANGES_PAGE_SIZE']
+    limit = min(limit, app.config['CHANGES_PAGE_SIZE'])
+    wait = request.args.get('wait', '0')
+    try:
+        wait = float(wait)
+    except ValueError:
+        raise ValueError('wait must be a number of seconds')
+    if not wait >= 0:
+        raise ValueError('wait must be a number of seconds')
+    return int(since), limit, min(wait, app.config['CHANGES_MAX_WAIT'])
+
+def wants_event_stream():
+    best = request.accept_mimetypes.best_match(['application/json', 'text/event-stream'])
+    return best == 'text/event-stream'
+
+def gone_response(since):
+    message = ('Changes after {} are no longer kept, reload the posts from '
+               '/api/posts'.format(since))
+    return api.error_response(message, 410)
+
+def format_events(changes):
+    ''' changes as server-sent events, named after their op '''
+    return b''.join(b'id: %d\nevent: %s\ndata: %s\n\n' % (
+        change['seq'], change['op'].encode('ascii'), dumps(change))
+        for change in changes)
+
+# sent on an idle event stream so proxies don't close it
+KEEPALIVE = b': keepalive\n\n'
+
+def wait_for_changes(since, limit, timeout):
+    '''
+    The changes after since, waiting up to timeout seconds for the first to
+    be committed.  Each check takes a connection from the pool only for as
+    long as the query runs.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        generation = notifier.generation
+        with engine.connect() as connection:
+            changes = read_changes(connection, since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        notifier.wait(generation, min(remaining, app.config['CHANGES_POLL_INTERVAL']))
+
+def stream_changes(since, limit):
+    ''' generate server-sent events for changes after since, until the client goes '''
+    while True:
+        changes = wait_for_changes(since, limit, app.config['CHANGES_KEEPALIVE'])
+        if changes:
+            since = changes[-1]['seq']
+            yield format_events(changes)
+        else:
+            yield KEEPALIVE
+
+@app.route('/api/posts/changes', methods = ['GET'])
+@decorators.admit
+@decorators.accept('application/json', 'text/event-stream')
+def posts_changes():
+    ''' the changes to posts after ?since=, as JSON or server-sent events '''
+    try:
+        since, limit, wait = changes_args()
+    except ValueError as error:
+        return api.error_response(str(error), 400)
+    with engine.connect() as connection:
+        if is_gone(connection, since):
+            return gone_response(since)
+
+    # waiting for changes doesn't need one of the request slots
+    if wants_event_stream():
+        admission.release()
+        generator = stream_with_context(stream_changes(since, limit))
+        return Response(generator, 200, mimetype = 'text/event-stream',
+                        headers = {'Cache-Control': 'no-cache'})
+    if wait:
+        admission.release()
+    changes = wait_for_changes(since, limit, wait)
+    return Response(dumps(changes), 200, mimetype = 'application/json')
+
+def prune(connection, retention):
+    '''
+    Remove changes older than retention seconds, keeping the newest entry
+    so is_gone can tell how far the log goes back.  Returns how many went.
+    '''
+    cutoff = models.utcnow() - datetime.timedelta(seconds = retention)
+    newest = select(func.max(change_log.c.seq)).scalar_subquery()
+    statement = delete(change_log).where(change_log.c.changed_at < cutoff,
+                                         change_log.c.seq < newest)
+    return connection.execute(statement).rowcount
+
+@app.cli.command('prune-changes')
+def prune_command():
+    ''' remove change log entries older than CHANGES_RETENTION seconds '''
+    with engine.begin() as connection:
+        count = prune(connection, app.config['CHANGES_RETENTION'])
+    click.echo('Pruned {} changes'.format(count))
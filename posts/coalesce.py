@@ -0,0 +1,62 @@
+import threading
+
+from . import signals
+
+# Single-flight coalescing for the read views.  When many clients ask for
+# the same thing at once, e.g. a post which has just been shared, the first
+# request runs the query and serializes the result while the others wait
+# for it and are answered with the same bytes.
+#
+# A committed write ends the sharing: requests arriving after it start a
+# new call rather than join one which may have read the table before it.
+
+class Flight(object):
+    ''' a call in progress, and its result once done '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+class SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func):
+        '''
+        Call func, unless a call for key is already in flight, in which case
+        wait for its result instead.  Returns the result and whether it was
+        shared.  Waiters make their own call if the one they waited on fails.
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.failed:
+                return func(), False
+            return flight.value, True
+        try:
+            flight.value = func()
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.done.set()
+        return flight.value, False
+
+    def forget(self):
+        ''' make later calls start afresh instead of joining those in flight '''
+        with self.lock:
+            self.flights.clear()
+
+reads = SingleFlight()
+
+@signals.posts_changed.connect
+def forget_reads(sender, **changes):
+    reads.forget()
@@ -0,0 +1,47 @@
+import gzip
+import zlib
+
+# Content codings for responses, in order of preference.  Brotli is used
+# when the brotli package is installed.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def compress(data, encoding, level = 6):
+    ''' compress a whole body '''
+    if encoding == 'br':
+        return brotli.compress(data, quality = level)
+    return gzip.compress(data, compresslevel = level, mtime = 0)
+
+class Compressor(object):
+    ''' compress a body a chunk at a time '''
+    def __init__(self, encoding, level = 6):
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality = level)
+            self.compress = self.compressor.process
+            self.flush = self.compressor.finish
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = self.compressor.compress
+            self.flush = self.compressor.flush
+
+def compress_stream(chunks, encoding, level = 6):
+    ''' compress a stream of bytes on the fly '''
+    compressor = Compressor(encoding, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def compress_async_stream(chunks, encoding, level = 6):
+    ''' compress_stream for the async generators served by posts.asgi '''
+    compressor = Compressor(encoding, level)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,10 +1,151 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session as BaseSession, sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 
 from posts import app
 
-engine = create_engine(app.config["DATABASE_URI"])
+def engine_options(config, uri = None):
+    ''' create_engine keyword arguments for the configured connection pool '''
+    options = {
+        'pool_pre_ping': config["POOL_PRE_PING"],
+        'pool_recycle': config["POOL_RECYCLE"]
+    }
+    if make_url(uri or config["DATABASE_URI"]).get_backend_name() != 'sqlite':
+        options['pool_size'] = config["POOL_SIZE"]
+        options['max_overflow'] = config["MAX_OVERFLOW"]
+        options['pool_timeout'] = config["POOL_TIMEOUT"]
+    return options
+
+class ReplicaRouter(object):
+    '''
+    Round-robin over the replica engines, skipping replicas which failed.
+    A failed replica is left alone for REPLICA_RETRY_SECONDS and then has to
+    answer a probe before it gets any more queries.
+    '''
+    def __init__(self, engines, retry):
+        self.engines = engines
+        self.retry = retry
+        # engine -> when it may be probed again
+        self.down = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        for engine in engines:
+            event.listen(engine, 'handle_error', self.handle_error)
+    
+    def handle_error(self, context):
+        dbapi = context.dialect.dbapi
+        if context.is_disconnect or isinstance(context.original_exception,
+                                               dbapi.OperationalError):
+            self.mark_down(context.engine)
+    
+    def mark_down(self, engine):
+        with self.lock:
+            self.down[engine] = time.monotonic() + self.retry
+    
+    def probe(self, engine):
+        ''' check a replica answers, marking it up or down '''
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except exc.DBAPIError:
+            self.mark_down(engine)
+            return False
+        with self.lock:
+            self.down.pop(engine, None)
+        return True
+    
+    def choose(self):
+        ''' the next healthy replica, or None if they are all down '''
+        for attempt in range(len(self.engines)):
+            engine = self.engines[next(self.counter) % len(self.engines)]
+            with self.lock:
+                retry_at = self.down.get(engine)
+                if retry_at is None:
+                    return engine
+                if retry_at > time.monotonic():
+                    continue
+                # only one request gets to probe it
+                self.down[engine] = time.monotonic() + self.retry
+            if self.probe(engine):
+                return engine
+        return None
+
+class RoutingSession(BaseSession):
+    ''' a session which reads from the replica chosen for the request, if any '''
+    def get_bind(self, mapper = None, **kw):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, **kw)
+
+engine = create_engine(app.config["DATABASE_URI"], **engine_options(app.config))
+replica_engines = [create_engine(uri, **engine_options(app.config, uri))
+                   for uri in app.config["REPLICA_URIS"]]
+router = (ReplicaRouter(replica_engines, app.config["REPLICA_RETRY_SECONDS"])
+          if replica_engines else None)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
\ No newline at end of file
+Session = sessionmaker(bind=engine, class_=RoutingSession)
+
+def reset_pools():
+    '''
+    Forget the connections inherited from the parent process, without
+    closing them under the parent's feet, so forked workers open their own.
+    '''
+    for pool_engine in [engine] + replica_engines:
+        pool_engine.dispose(close = False)
+
+os.register_at_fork(after_in_child = reset_pools)
+
+# Each thread gets its own session, which is closed when the request ends so
+# a failed transaction never leaks into the next request.
+session = scoped_session(Session)
+
+@app.teardown_appcontext
+def remove_session(exception = None):
+    session.remove()
+
+# clients which just wrote read from the primary for a while, so they see
+# their own writes however far the replicas lag
+READ_PRIMARY_COOKIE = 'posts_read_primary'
+
+def read_only(func):
+    '''
+    Decorator for views which only read, sending their queries to a replica.
+    A replica failing mid-request is marked down and the view is run again
+    on the primary.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if router is None or request.cookies.get(READ_PRIMARY_COOKIE):
+            return func(*args, **kwargs)
+        replica = router.choose()
+        if replica is None:
+            return func(*args, **kwargs)
+        session.info['replica'] = replica
+        try:
+            return func(*args, **kwargs)
+        except exc.OperationalError:
+            session.rollback()
+            session.info.pop('replica', None)
+            return func(*args, **kwargs)
+    return wrapper
+
+def uses_replica():
+    ''' whether the current request reads from a replica '''
+    return session.info.get('replica') is not None
+
+@app.after_request
+def remember_writes(response):
+    if (router is not None and response.status_code < 400 and
+            request.method in ('POST', 'PUT', 'PATCH', 'DELETE')):
+        response.set_cookie(READ_PRIMARY_COOKIE, '1', httponly = True,
+                            max_age = app.config["REPLICA_LAG_SECONDS"])
+    return response
@@ -1,36 +1,250 @@
-import json
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
 from functools import wraps
 
-from flask import request, Response
+from flask import current_app, make_response, request, Response
 
-def accept(mimetype):
+from . import admission
+from . import compression
+from posts import app
+from .serializers import binary_formats, dumps, loads
+
+def offered(mimetype):
+    ''' the formats a view producing mimetype can be served in, preferred first '''
+    if mimetype == 'application/json':
+        return [mimetype] + list(binary_formats)
+    return [mimetype]
+
+def not_acceptable(*mimetypes):
+    message = 'Request must accept {} data'.format(' or '.join(mimetypes))
+    data = dumps({ 'message': message })
+    return Response(data, 406, mimetype = 'application/json')
+
+# Every format and content coding a response is re-encoded in gets an
+# entity tag of its own, the view's tag with a suffix, so caches never take
+# one representation for another.  Conditional requests compare the view's
+# tag, whichever representation the client holds.
+
+def format_name(mimetype):
+    ''' the name of a format in entity tags, the same for its x- alias '''
+    subtype = mimetype.partition('/')[2]
+    return subtype[2:] if subtype.startswith('x-') else subtype
+
+representation_suffixes = tuple(sorted(
+    set('-' + format_name(format) for format in binary_formats) |
+    set('-' + encoding for encoding in compression.encodings)))
+
+def view_etag(etag):
+    ''' the tag a view gave a response, before it was re-encoded '''
+    while etag.endswith(representation_suffixes):
+        etag = etag.rpartition('-')[0]
+    return etag
+
+class EncodedBodies(object):
+    '''
+    Re-encoded and compressed bodies, keyed by a digest of the original, so
+    a post or listing which hasn't changed is only encoded once.  Least
+    recently used bodies go once they take more than max_bytes.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+    
+    def set(self, key, data):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                key, old = self.entries.popitem(last = False)
+                self.size -= len(old)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+encoded_bodies = EncodedBodies(app.config['ENCODED_CACHE_BYTES'])
+
+def tag_representation(response, suffix):
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag('{}-{}'.format(etag, suffix), weak)
+
+def recode(response, suffix, encode):
+    '''
+    Replace the body of a response with encode(body), and tag it as a
+    representation of its own.  Tagged GET responses are the ones asked for
+    again unchanged, so their encoded bodies are kept in encoded_bodies.
+    '''
+    data = response.get_data()
+    if response.get_etag()[0] is None or request.method != 'GET':
+        encoded = encode(data)
+    else:
+        # ids are reused, so a tag may name a different body than it once did
+        key = (suffix, hashlib.sha1(data).digest())
+        encoded = encoded_bodies.get(key)
+        if encoded is None:
+            encoded = encode(data)
+            encoded_bodies.set(key, encoded)
+    response.set_data(encoded)
+    tag_representation(response, suffix)
+
+def negotiate(response, mimetype):
+    '''
+    Serve a view's response in the format the client prefers, re-encoding
+    JSON as MessagePack if that is what it asked for, and compress it.
+    Streamed responses are always JSON.
+    '''
+    response = make_response(response)
+    formats = offered(mimetype)
+    if len(formats) > 1:
+        response.vary.add('Accept')
+    best = request.accept_mimetypes.best_match(formats, default = mimetype)
+    if best in binary_formats and response.status_code == 304:
+        # tagged as the body it stands in for would have been
+        tag_representation(response, format_name(best))
+    elif best in binary_formats and response.mimetype == 'application/json':
+        if response.is_streamed:
+            if 'application/json' not in request.accept_mimetypes:
+                return not_acceptable('application/json')
+        else:
+            recode(response, format_name(best),
+                   lambda data: binary_formats[best](loads(data)))
+            response.mimetype = best
+    return compress(response)
+
+def compress(response):
+    '''
+    Compress a response with the best content coding the client accepts.
+    Small bodies are not worth it; streams are compressed as they go.
+    '''
+    if (request.method == 'HEAD' or response.status_code == 204 or
+            'Content-Encoding' in response.headers):
+        return response
+    # a compressor holds back events until it has a block's worth
+    if response.mimetype == 'text/event-stream':
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(compression.encodings)
+    if encoding is None:
+        return response
+    # the tag names the coding the client takes, even when the body is too
+    # small to be compressed, so it is the same on a 304
+    if response.status_code == 304:
+        tag_representation(response, encoding)
+        return response
+    level = current_app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        if hasattr(response.response, '__aiter__'):
+            response.response = compression.compress_async_stream(
+                response.response, encoding, level)
+        else:
+            response.response = compression.compress_stream(
+                response.response, encoding, level)
+    else:
+        if len(response.get_data()) < current_app.config['COMPRESS_MIN_SIZE']:
+            tag_representation(response, encoding)
+            return response
+        recode(response, encoding,
+               lambda data: compression.compress(data, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def accept(mimetype, *others):
     def decorator(func):
         '''
         Decorator which returns a 406 Not Acceptable if the client won't accept
-        a certain mimetype
+        a certain mimetype, or one of the binary formats offered for JSON.
+        Views which can also respond in other mimetypes name them after it.
         '''
+        formats = offered(mimetype) + list(others)
+        def acceptable():
+            return any(format in request.accept_mimetypes for format in formats)
+
+        # the async views in posts.asgi are wrapped the same way
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if acceptable():
+                    return negotiate(await func(*args, **kwargs), mimetype)
+                return not_acceptable(mimetype, *others)
+            return wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if mimetype in request.accept_mimetypes:
-                return func(*args, **kwargs)
-            message = 'Request must accept {} data'.format(mimetype)
-            data = json.dumps({ 'message': message })
-            return Response(data, 406, mimetype = 'application/json')
+            if acceptable():
+                return negotiate(func(*args, **kwargs), mimetype)
+            return not_acceptable(mimetype, *others)
         return wrapper
     return decorator
-    
-def require(mimetype):
+
+def require(*mimetypes):
     def decorator(func):
         '''
         Decorator which returns a 415 Unsupported Media Type if the client sends
-        something other than a certain mimetype
+        something other than one of the given mimetypes
         '''
+        def unsupported():
+            message = 'Request must contain {} data'.format(' or '.join(mimetypes))
+            data = dumps({ 'message': message })
+            return Response(data, 415, mimetype = 'application/json')
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if request.mimetype in mimetypes:
+                    return await func(*args, **kwargs)
+                return unsupported()
+            return wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if request.mimetype == mimetype:
+            if request.mimetype in mimetypes:
                 return func(*args, **kwargs)
-            message = 'Request must contain {} data'.format(mimetype)
-            data = json.dumps({ 'message': message })
-            return Response(data, 415, mimetype = 'application/json')
+            return unsupported()
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def admit(func):
+    '''
+    Decorator which turns a request away with a 429 Too Many Requests if the
+    client is over its rate limit, or a 503 Service Unavailable if too many
+    requests are running and no slot comes free in time
+    '''
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            response = admission.rate_limited()
+            if response:
+                return response
+            # wait for a slot without holding up the event loop
+            if not await admission.acquire_async():
+                return admission.busy_response()
+            admission.admitted()
+            return await func(*args, **kwargs)
+        return wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        response = admission.rate_limited()
+        if response:
+            return response
+        if not admission.acquire():
+            return admission.busy_response()
+        admission.admitted()
+        return func(*args, **kwargs)
+    return wrapper
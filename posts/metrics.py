@@ -0,0 +1,193 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, Response, has_app_context
+from sqlalchemy import event
+
+from . import models
+from posts import app
+from .cache import post_cache
+from .database import engine, replica_engines, Session
+
+# Per-request instrumentation, exported in the Prometheus text format at
+# /metrics.  Every request records its latency, the number of SQL statements
+# it ran and their total time, the ORM rows it loaded and the time spent in
+# named phases such as serialization and commit.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+class Counter(object):
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(
+                    self.name, format_labels(self.labels, labels), value))
+        return lines
+
+class Histogram(object):
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> ([count per bucket], sum, count)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total, count = self.values.get(labels) or ([0] * len(self.buckets), 0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[labels] = (counts, total + value, count + 1)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name,
+                        format_labels(self.labels, labels, [('le', bound)]), bucket_count))
+                lines.append('{}_bucket{} {}'.format(self.name,
+                    format_labels(self.labels, labels, [('le', '+Inf')]), count))
+                lines.append('{}_sum{} {}'.format(self.name,
+                    format_labels(self.labels, labels), total))
+                lines.append('{}_count{} {}'.format(self.name,
+                    format_labels(self.labels, labels), count))
+        return lines
+
+requests_total = Counter('posts_requests_total',
+    'Requests handled, by route and status', ('method', 'route', 'status'))
+request_seconds = Histogram('posts_request_duration_seconds',
+    'Request latency by route', ('method', 'route'))
+query_count = Histogram('posts_request_queries',
+    'SQL statements executed per request', ('route',), COUNT_BUCKETS)
+query_seconds = Histogram('posts_request_query_seconds',
+    'Time spent executing SQL per request', ('route',))
+rows_loaded = Histogram('posts_request_rows',
+    'ORM rows loaded per request', ('route',), ROW_BUCKETS)
+phase_seconds = Histogram('posts_request_phase_seconds',
+    'Time spent per request in serialization and commit', ('route', 'phase'))
+
+coalesced_requests = Counter('posts_coalesced_requests_total',
+    'Requests answered with the result of an identical request in flight', ('route',))
+
+registry = [requests_total, request_seconds, query_count, query_seconds,
+            rows_loaded, phase_seconds, coalesced_requests]
+
+def route():
+    return request.endpoint or 'unmatched'
+
+def add_phase(phase, seconds):
+    ''' add time spent in a phase of the current request, if there is one '''
+    if has_app_context() and 'metrics_phases' in g:
+        g.metrics_phases[phase] = g.metrics_phases.get(phase, 0) + seconds
+
+@contextmanager
+def timed(phase):
+    ''' add the time spent in the block to a phase of the current request '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - start)
+
+@app.before_request
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = []
+    g.metrics_rows = 0
+    g.metrics_phases = {}
+
+@app.after_request
+def record_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    name = route()
+    requests_total.inc(request.method, name, response.status_code)
+    request_seconds.observe(elapsed, request.method, name)
+    query_count.observe(len(g.metrics_queries), name)
+    query_seconds.observe(sum(seconds for statement, seconds in g.metrics_queries), name)
+    rows_loaded.observe(g.metrics_rows, name)
+    for phase, seconds in g.metrics_phases.items():
+        phase_seconds.observe(seconds, name, phase)
+
+    threshold = app.config.get("SLOW_REQUEST_SECONDS")
+    if threshold is not None and elapsed >= threshold:
+        statements = '\n'.join('  {:.6f}s {}'.format(seconds, ' '.join(statement.split()))
+                               for statement, seconds in g.metrics_queries)
+        app.logger.warning('Slow request %s %s took %.3fs with %d queries:\n%s',
+                           request.method, request.full_path, elapsed,
+                           len(g.metrics_queries), statements)
+    return response
+
+def instrument(engine):
+    ''' time every statement run on engine during a request '''
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(connection, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_query(connection, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'metrics_queries' in g:
+            seconds = time.perf_counter() - context.metrics_start
+            g.metrics_queries.append((statement, seconds))
+
+instrument(engine)
+for replica in replica_engines:
+    instrument(replica)
+
+@event.listens_for(models.Post, 'load')
+def count_row(target, context):
+    if has_app_context() and 'metrics_rows' in g:
+        g.metrics_rows += 1
+
+@event.listens_for(Session, 'before_commit')
+def start_commit(session):
+    session.info['metrics_commit_start'] = time.perf_counter()
+
+@event.listens_for(Session, 'after_commit')
+def record_commit(session):
+    start = session.info.pop('metrics_commit_start', None)
+    if start is not None:
+        add_phase('commit', time.perf_counter() - start)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    ''' Prometheus exposition of the request metrics '''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    stats = post_cache.stats()
+    for name in ('hits', 'misses'):
+        lines.extend(['# HELP posts_cache_{}_total Post cache {}'.format(name, name),
+                      '# TYPE posts_cache_{}_total counter'.format(name),
+                      'posts_cache_{}_total {}'.format(name, stats[name])])
+    return Response('\n'.join(lines) + '\n', 200,
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8')
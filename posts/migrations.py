@@ -0,0 +1,111 @@
+import click
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import inspect, select, text
+
+from . import models
+from posts import app
+from .database import engine
+
+# Versioned schema migrations.  Importing posts never touches the database;
+# the schema is brought up to date explicitly before the app is started:
+#
+#     flask --app posts migrate
+#
+# The version applied last is kept in the schema_version table.  Each
+# migration is idempotent, so a database created by the old create_all at
+# import time upgrades cleanly.
+
+migrations = []
+
+def migration(version):
+    ''' register an upgrade step, run in order of version '''
+    def decorator(func):
+        migrations.append((version, func))
+        migrations.sort(key = lambda item: item[0])
+        return func
+    return decorator
+
+schema_version = Table('schema_version', MetaData(),
+    Column('version', Integer, nullable = False))
+
+@migration(1)
+def create_posts(connection):
+    ''' create the posts table '''
+    posts = Table('posts', MetaData(),
+        Column('id', Integer, primary_key = True),
+        Column('title', String(128)),
+        Column('body', String(1024)))
+    posts.create(connection, checkfirst = True)
+
+@migration(2)
+def add_validators(connection):
+    ''' add the version and updated_at columns behind ETags '''
+    columns = set(column['name'] for column in inspect(connection).get_columns('posts'))
+    if 'version' not in columns:
+        connection.execute(text(
+            'ALTER TABLE posts ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+    if 'updated_at' in columns:
+        return
+    if connection.dialect.name == 'sqlite':
+        # SQLite can't add a column defaulting to the current time
+        connection.execute(text('ALTER TABLE posts ADD COLUMN updated_at TIMESTAMP'))
+        connection.execute(text('UPDATE posts SET updated_at = :now'),
+                           {'now': models.utcnow()})
+    else:
+        connection.execute(text("ALTER TABLE posts ADD COLUMN updated_at TIMESTAMP "
+                                "NOT NULL DEFAULT (now() AT TIME ZONE 'utc')"))
+
+@migration(3)
+def add_search_indexes(connection):
+    ''' add the Postgres indexes behind title_like, body_like and q '''
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    for index in models.Post.__table__.indexes:
+        index.create(connection, checkfirst = True)
+
+@migration(4)
+def create_post_changes(connection):
+    ''' create the change log behind GET /api/posts/changes '''
+    post_changes = Table('post_changes', MetaData(),
+        Column('seq', Integer, primary_key = True),
+        Column('post_id', Integer, nullable = False),
+        Column('op', String(6), nullable = False),
+        Column('title', String(128)),
+        Column('body', String(1024)),
+        Column('changed_at', DateTime, nullable = False, index = True),
+        sqlite_autoincrement = True)
+    post_changes.create(connection, checkfirst = True)
+
+def current_version(connection):
+    ''' the version of the schema, 0 for an empty database '''
+    if not inspect(connection).has_table('schema_version'):
+        return 0
+    return connection.execute(select(schema_version.c.version)).scalar() or 0
+
+def upgrade(bind = engine, target = None):
+    ''' apply the pending migrations up to target, returning their versions '''
+    applied = []
+    with bind.begin() as connection:
+        schema_version.create(connection, checkfirst = True)
+        version = current_version(connection)
+        for number, func in migrations:
+            if number <= version or (target is not None and number > target):
+                continue
+            func(connection)
+            applied.append(number)
+        if applied:
+            connection.execute(schema_version.delete())
+            connection.execute(schema_version.insert().values(version = applied[-1]))
+    return applied
+
+@app.cli.command('migrate')
+@click.option('--to', 'target', type = int, help = 'stop at this version')
+def migrate_command(target):
+    ''' bring the database schema up to date '''
+    applied = upgrade(target = target)
+    for number in applied:
+        func = dict(migrations)[number]
+        click.echo('Applied {} {}'.format(number, func.__name__))
+    if not applied:
+        click.echo('Already up to date')
@@ -1,11 +1,20 @@
-from sqlalchemy import Column, Integer, String, Sequence
+import datetime
+
+from sqlalchemy import Column, Integer, String, Sequence, DateTime
+from sqlalchemy import DDL, Index, event, func, literal_column, text
 
 from .database import Base
 
+def utcnow():
+    ''' naive UTC timestamps, as stored in updated_at '''
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo = None)
+
 class Post(Base):
     __tablename__ = 'posts'
     
-    def as_dictionary(self):
+    def as_dictionary(self, fields = None):
+        if fields is not None:
+            return dict((field, getattr(self, field)) for field in fields)
         post = {
             "id": self.id,
             "title": self.title,
@@ -15,4 +24,60 @@ class Post(Base):
     
     id = Column(Integer, primary_key = True)
     title = Column(String(128))
-    body = Column(String(1024))
\ No newline at end of file
+    body = Column(String(1024))
+    # validators for conditional requests, maintained on every UPDATE
+    # including bulk and Core statements that never load the row
+    version = Column(Integer, nullable = False, default = 1,
+                     onupdate = literal_column('version') + 1)
+    updated_at = Column(DateTime, nullable = False, default = utcnow,
+                        onupdate = utcnow)
+
+class PostChange(Base):
+    '''
+    An entry in the change log behind GET /api/posts/changes, written in the
+    same transaction as the change.  Deletes leave the title and body empty.
+    '''
+    __tablename__ = 'post_changes'
+    # never reuse the sequence numbers of pruned entries
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    def as_dictionary(self):
+        change = {
+            "seq": self.seq,
+            "op": self.op,
+            "id": self.post_id
+        }
+        if self.op != 'delete':
+            change["title"] = self.title
+            change["body"] = self.body
+        return change
+    
+    seq = Column(Integer, primary_key = True)
+    post_id = Column(Integer, nullable = False)
+    op = Column(String(6), nullable = False)
+    title = Column(String(128))
+    body = Column(String(1024))
+    changed_at = Column(DateTime, nullable = False, default = utcnow, index = True)
+
+def search_vector():
+    '''
+    The tsvector searched by ?q= on Postgres.  The query has to use exactly
+    this expression for the planner to pick the GIN index below.
+    '''
+    empty, space = text("''"), text("' '")
+    document = (func.coalesce(Post.title, empty) + space +
+                func.coalesce(Post.body, empty))
+    return func.to_tsvector(text("'simple'"), document)
+
+# Trigram GIN indexes let Postgres answer the leading-wildcard LIKE behind
+# title_like/body_like without scanning the table.  Other databases rely on
+# the in-process index in posts.search instead.
+event.listen(Post.__table__, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect = 'postgresql'))
+Index('ix_posts_title_trgm', Post.title, postgresql_using = 'gin',
+      postgresql_ops = {'title': 'gin_trgm_ops'}).ddl_if(dialect = 'postgresql')
+Index('ix_posts_body_trgm', Post.body, postgresql_using = 'gin',
+      postgresql_ops = {'body': 'gin_trgm_ops'}).ddl_if(dialect = 'postgresql')
+Index('ix_posts_search', search_vector(),
+      postgresql_using = 'gin').ddl_if(dialect = 'postgresql')
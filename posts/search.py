@@ -0,0 +1,288 @@
+import bisect
+import json
+import re
+import string
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event, func, or_, select, text
+
+from . import models
+from . import signals
+from posts import app
+from .database import engine
+
+# Postgres answers searches from the indexes declared in posts.models.  Any
+# other database (SQLite for local work and testing) gets an in-process
+# inverted index which narrows the candidate rows by primary key; the
+# original LIKE filter is still applied so results are unchanged.
+#
+# Only titles are indexed for substring filters (body_like is plain LIKE)
+# and tables of more than SEARCH_INDEX_MAX_ROWS posts aren't indexed at
+# all, as the postings take several kilobytes per post.  The index is built
+# on a thread of its own; until it is ready, searches use LIKE alone.
+#
+# Writes in this process reach the index through signals.posts_changed.
+# Writes made by other processes, or by CLI commands, are picked up by
+# rebuilding it from the database once it is SEARCH_INDEX_MAX_AGE seconds
+# old.  Terms matching more than SEARCH_MAX_CANDIDATES posts narrow too
+# little to be worth sending the ids, and are left to LIKE alone.
+
+TOKEN_RE = re.compile(r'\w+')
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+SIMPLE = text("'simple'")
+
+def fold(text):
+    ''' lowercase ASCII only, like SQLite's case-insensitive LIKE '''
+    return (text or '').translate(ASCII_LOWER)
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def tokens(text):
+    return set(TOKEN_RE.findall((text or '').lower()))
+
+class InvertedIndex(object):
+    '''
+    Trigram postings of titles for substring filters, and word postings over
+    a sorted vocabulary for token prefix search.  Built from the database in
+    the background, kept current through signals.posts_changed and rebuilt
+    once it is max_age seconds old.  Tables of more than max_rows posts are
+    not indexed.
+    '''
+    def __init__(self, max_age = None, max_rows = None):
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.generation = 0
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            # bumped so a rebuild running across a reset is thrown away
+            self.generation += 1
+            self.built_at = None
+            # the table had more than max_rows posts at the last build
+            self.too_large = False
+            # changes committed while a rebuild is reading the table, as
+            # (id, (title, body)), or (id, None) for a removed post
+            self.pending = None
+            self.clear()
+    
+    def clear(self):
+        # id -> (title, words) of each indexed post
+        self.documents = {}
+        self.grams = defaultdict(set)
+        self.postings = defaultdict(set)
+        self.vocabulary = []
+    
+    @property
+    def built(self):
+        return self.built_at is not None
+    
+    def usable(self):
+        return self.built and not self.too_large
+    
+    def fresh(self):
+        return self.built and (self.max_age is None or
+                               time.monotonic() - self.built_at < self.max_age)
+    
+    def ensure_built(self):
+        '''
+        Start building the index on a thread of its own if it is missing or
+        stale.  Searches carry on with the old postings, or without any,
+        while it runs.
+        '''
+        if self.fresh() or not self.build_lock.acquire(blocking = False):
+            return
+        def build():
+            try:
+                self._rebuild()
+            finally:
+                self.build_lock.release()
+        threading.Thread(target = build, name = 'posts-search-index',
+                         daemon = True).start()
+    
+    def rebuild(self):
+        ''' build the index now, on this thread '''
+        with self.build_lock:
+            self._rebuild()
+    
+    def _rebuild(self):
+        ''' read the whole table into new postings and swap them in '''
+        with self.lock:
+            generation = self.generation
+            self.pending = pending = []
+        try:
+            built = self.read()
+        finally:
+            with self.lock:
+                self.pending = None
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.too_large = built is None
+            if built is None:
+                self.clear()
+            else:
+                for id, document in pending:
+                    if document is None:
+                        built._discard(id)
+                    else:
+                        built._add(id, *document)
+                self.documents = built.documents
+                self.grams = built.grams
+                self.postings = built.postings
+                self.vocabulary = built.vocabulary
+            self.built_at = time.monotonic()
+    
+    def read(self):
+        ''' a new index of the table, or None if it has more than max_rows posts '''
+        built = InvertedIndex()
+        table = models.Post.__table__
+        query = select(table.c.id, table.c.title, table.c.body)
+        with engine.connect() as connection:
+            rows = connection.execution_options(yield_per = 1000)
+            for count, row in enumerate(rows.execute(query), 1):
+                if self.max_rows is not None and count > self.max_rows:
+                    return None
+                built._add(row.id, row.title, row.body)
+        return built
+    
+    def add(self, id, title, body):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((id, (title, body)))
+            if self.usable():
+                self._add(id, title, body)
+    
+    def discard(self, id):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((id, None))
+            self._discard(id)
+    
+    def _add(self, id, title, body):
+        self._discard(id)
+        words = frozenset(tokens(title) | tokens(body))
+        self.documents[id] = (title, words)
+        for gram in trigrams(fold(title)):
+            self.grams[gram].add(id)
+        for token in words:
+            if token not in self.postings:
+                bisect.insort(self.vocabulary, token)
+            self.postings[token].add(id)
+    
+    def _discard(self, id):
+        document = self.documents.pop(id, None)
+        if document is None:
+            return
+        title, words = document
+        for gram in trigrams(fold(title)):
+            self.grams[gram].discard(id)
+            if not self.grams[gram]:
+                del self.grams[gram]
+        for token in words:
+            self.postings[token].discard(id)
+            if not self.postings[token]:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+    
+    def title_substring(self, term):
+        '''
+        Ids whose title may contain term, or None when the index can't tell:
+        the term is too short for trigrams or the index isn't ready.
+        '''
+        grams = trigrams(fold(term))
+        if not grams:
+            return None
+        self.ensure_built()
+        with self.lock:
+            if not self.usable():
+                return None
+            postings = sorted((self.grams.get(gram, ()) for gram in grams), key = len)
+            return set(postings[0]).intersection(*postings[1:])
+    
+    def prefix(self, words):
+        '''
+        Ids with a word starting with each of the given words, or None when
+        the index isn't ready.
+        '''
+        self.ensure_built()
+        result = None
+        with self.lock:
+            if not self.usable():
+                return None
+            for word in words:
+                matched = set()
+                position = bisect.bisect_left(self.vocabulary, word)
+                while (position < len(self.vocabulary) and
+                       self.vocabulary[position].startswith(word)):
+                    matched.update(self.postings[self.vocabulary[position]])
+                    position += 1
+                result = matched if result is None else result & matched
+                if not result:
+                    break
+        return result or set()
+
+index = InvertedIndex(app.config['SEARCH_INDEX_MAX_AGE'],
+                      app.config['SEARCH_INDEX_MAX_ROWS'])
+
+def uses_database_index():
+    return engine.dialect.name == 'postgresql'
+
+def id_in(ids):
+    ''' filter on a set of post ids of any size '''
+    ids = sorted(ids)
+    if engine.dialect.name == 'sqlite':
+        # a single JSON parameter sidesteps SQLite's bound variable limit
+        values = func.json_each(json.dumps(ids)).table_valued('value')
+        return models.Post.id.in_(select(values.c.value))
+    return models.Post.id.in_(ids)
+
+def filter_contains(query, column, term):
+    ''' filter a Post query to rows where column contains term '''
+    query = query.filter(column.contains(term))
+    # LIKE wildcards in the term make trigram candidates meaningless
+    if (uses_database_index() or column.key != 'title' or
+            '%' in term or '_' in term):
+        return query
+    ids = index.title_substring(term)
+    if ids is None or len(ids) > app.config['SEARCH_MAX_CANDIDATES']:
+        return query
+    return query.filter(id_in(ids))
+
+def filter_tokens(query, text):
+    '''
+    Filter a Post query to rows where every word of text is the prefix of a
+    word in the title or body.
+    '''
+    words = sorted(tokens(text))
+    if not words:
+        return query
+    if uses_database_index():
+        tsquery = ' & '.join(word + ':*' for word in words)
+        match = models.search_vector().op('@@')(func.to_tsquery(SIMPLE, tsquery))
+        return query.filter(match)
+    ids = index.prefix(words)
+    if ids is not None:
+        return query.filter(id_in(ids))
+    # until the index is ready, or for tables too large for it, each word
+    # is matched anywhere in the title or body rather than at a word start
+    for word in words:
+        query = query.filter(or_(models.Post.title.contains(word, autoescape = True),
+                                 models.Post.body.contains(word, autoescape = True)))
+    return query
+
+@signals.posts_changed.connect
+def update_index(sender, created = (), updated = (), deleted = ()):
+    for post in list(created) + list(updated):
+        index.add(post['id'], post['title'], post['body'])
+    for id in deleted:
+        index.discard(id)
+
+# recreating or dropping the table invalidates everything we know
+event.listen(models.Post.__table__, 'after_create', lambda *args, **kw: index.reset())
+event.listen(models.Post.__table__, 'after_drop', lambda *args, **kw: index.reset())
@@ -0,0 +1,49 @@
+import json
+
+# Use the fastest JSON library available.  Every function here works in
+# bytes so responses can be written out without another encoding step.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+    
+    loads = orjson.loads
+elif ujson is not None:
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii = False).encode('utf-8')
+    
+    loads = ujson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii = False,
+                          separators = (',', ':')).encode('utf-8')
+    
+    loads = json.loads
+
+def dumps_items(items):
+    '''
+    Serialize a list as the comma separated items of a JSON array, without
+    the brackets, so chunks of a large array can be written one at a time.
+    '''
+    return dumps(items)[1:-1]
+
+# Compact binary formats offered as alternatives to JSON, by mimetype.
+# Each takes the same objects as dumps.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+binary_formats = {}
+if msgpack is not None:
+    binary_formats['application/msgpack'] = msgpack.packb
+    binary_formats['application/x-msgpack'] = msgpack.packb
@@ -0,0 +1,188 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from . import snapshot
+from . import writebehind
+from .cache import post_cache
+
+# A pre-forking production server for the WSGI app:
+#
+#     WORKERS=8 python run.py --production
+#
+# The app is imported once in the master, which opens the listening socket
+# and forks WORKERS processes (one per CPU by default) to accept from it.
+# Each worker serves requests on threads.  Database pools are reset in every
+# child by posts.database, so no worker shares its parent's sockets.
+#
+# Signals to the master:
+#   HUP        replace the workers one at a time, without dropping requests
+#   TERM, INT  stop accepting, let in-flight requests finish, and exit
+#
+# The app stays preloaded across HUP, so a reload picks up fresh database
+# connections and workers, not new code.  Workers which die within a second
+# of starting are replaced after a delay, doubling up to 30 seconds while
+# they keep failing, rather than forked again in a tight loop.
+#
+# Workers don't see each other's writes in what they keep in memory, only
+# through the database.  With more than one worker:
+#   - the post cache should be shared with CACHE_BACKEND=redis.  A local
+#     cache keeps its entries for at most CACHE_LOCAL_TTL seconds instead of
+#     CACHE_TTL, so a post changed by another worker is served stale (with
+#     its old ETag) for no longer than that
+#   - the listing snapshot and, off Postgres, the search index are rebuilt
+#     from the database after SNAPSHOT_MAX_AGE and SEARCH_INDEX_MAX_AGE
+#     seconds, which bound how long other workers' writes go unseen there
+
+class Arbiter(object):
+    # workers exiting sooner than this after starting are failing to start
+    min_lifetime = 1
+    max_backoff = 30
+
+    def __init__(self, app, sock, workers, timeout = 30):
+        self.app = app
+        self.sock = sock
+        self.count = workers
+        self.timeout = timeout
+        # pid -> when the worker was started
+        self.workers = {}
+        self.reloading = False
+        self.stopping = False
+        # seconds to wait before replacing a worker which failed to start
+        self.backoff = 0
+        self.respawn_at = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        # a worker never returns into the master's code
+        status = 1
+        try:
+            self.serve()
+            status = 0
+        except Exception:
+            self.app.logger.exception('Worker %d failed', os.getpid())
+        finally:
+            os._exit(status)
+
+    def serve(self):
+        ''' run one worker until it is told to stop '''
+        host, port = self.sock.getsockname()[:2]
+        server = make_server(host, port, self.app, threaded = True,
+                             fd = self.sock.fileno())
+        # let in-flight requests finish when shutting down
+        server.daemon_threads = False
+        server.block_on_close = True
+
+        def stop(signum, frame):
+            threading.Thread(target = server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server.serve_forever()
+        server.server_close()
+        # atexit handlers don't run in a forked worker
+        writebehind.write_queue.close()
+
+    def stop_worker(self, pid):
+        ''' stop a worker gracefully, killing it if it takes too long '''
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if finished:
+                break
+            time.sleep(0.05)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.pop(pid, None)
+
+    def reap(self):
+        ''' forget workers which have exited '''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            self.app.logger.warning('Worker %d exited with status %d', pid,
+                                    os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < self.min_lifetime:
+                self.backoff = min(max(self.backoff * 2, 0.5), self.max_backoff)
+                self.respawn_at = time.monotonic() + self.backoff
+                self.app.logger.warning('Replacing it in %s seconds', self.backoff)
+            else:
+                self.backoff = 0
+
+    def reload(self):
+        ''' start a new worker for each old one before stopping the old one '''
+        for pid in list(self.workers):
+            self.spawn()
+            self.stop_worker(pid)
+
+    def run(self):
+        def reload(signum, frame):
+            self.reloading = True
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGHUP, reload)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            self.reap()
+            # replace workers which died
+            while (len(self.workers) < self.count and
+                   time.monotonic() >= self.respawn_at):
+                self.spawn()
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            time.sleep(0.1)
+
+        for pid in list(self.workers):
+            self.stop_worker(pid)
+        self.sock.close()
+
+def listen(host, port, backlog):
+    sock = socket.create_server((host, port), backlog = backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def limit_local_cache(app, workers):
+    ''' keep a cache private to each worker from going stale for long '''
+    if workers < 2 or app.config['CACHE_BACKEND'] != 'local':
+        return
+    ttl = app.config['CACHE_LOCAL_TTL']
+    post_cache.ttl = min(post_cache.ttl, ttl) if post_cache.ttl else ttl
+    app.logger.warning('The post cache is local to each of %d workers, so '
+                       'entries are kept for %s seconds; set CACHE_BACKEND=redis '
+                       'to share it', workers, post_cache.ttl)
+
+def serve(app, host, port):
+    ''' serve app with the configured workers until told to stop '''
+    sock = listen(host, port, app.config['BACKLOG'])
+    limit_local_cache(app, app.config['WORKERS'])
+    # built once in the master, so every worker starts with a copy
+    snapshot.preload()
+    app.logger.info('Listening on %s:%d with %d workers', host, port,
+                    app.config['WORKERS'])
+    Arbiter(app, sock, app.config['WORKERS'], app.config['GRACEFUL_TIMEOUT']).run()
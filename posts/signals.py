@@ -0,0 +1,56 @@
+from blinker import Namespace
+from sqlalchemy import event
+
+from . import models
+from posts import app
+from .database import Session
+
+_signals = Namespace()
+
+# Sent after a commit which changed posts.  Receivers get `created` and
+# `updated` lists of post dictionaries and a `deleted` list of ids.
+posts_changed = _signals.signal('posts-changed')
+
+def send_posts_changed(created = (), updated = (), deleted = ()):
+    ''' notify receivers about posts changed by a committed transaction '''
+    if created or updated or deleted:
+        posts_changed.send(app, created = list(created),
+                           updated = list(updated), deleted = list(deleted))
+
+# Changes are collected on the session and only announced once the
+# transaction actually commits.  ORM writes are picked up at every flush;
+# writes made with Core statements stage their changes before committing.
+
+def stage_post_changes(session, created = (), updated = (), deleted = ()):
+    ''' add changes to those announced once session commits '''
+    changes = session.info.setdefault('post_changes', ({}, {}, set()))
+    created_posts, updated_posts, deleted_ids = changes
+    for post in created:
+        created_posts[post['id']] = post
+    for post in updated:
+        target = created_posts if post['id'] in created_posts else updated_posts
+        target[post['id']] = post
+    for id in deleted:
+        created_posts.pop(id, None)
+        updated_posts.pop(id, None)
+        deleted_ids.add(id)
+
+@event.listens_for(Session, 'after_flush')
+def collect_post_changes(session, flush_context):
+    posts = [obj for obj in session.new if isinstance(obj, models.Post)]
+    changed = [obj for obj in session.dirty
+               if isinstance(obj, models.Post) and session.is_modified(obj)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, models.Post)]
+    stage_post_changes(session, [post.as_dictionary() for post in posts],
+                       [post.as_dictionary() for post in changed], deleted)
+
+@event.listens_for(Session, 'after_commit')
+def announce_post_changes(session):
+    changes = session.info.pop('post_changes', None)
+    if changes:
+        created, updated, deleted = changes
+        send_posts_changed(created.values(), updated.values(), deleted)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_post_changes(session):
+    session.info.pop('post_changes', None)
@@ -0,0 +1,213 @@
+import hashlib
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event, func, select
+
+from . import models
+from . import signals
+from posts import app
+from .database import engine
+from .serializers import dumps
+
+# A pre-serialized copy of the unfiltered listing, GET /api/posts with no
+# arguments.  Posts are kept as JSON in chunks of SNAPSHOT_PAGE_SIZE ids, so
+# a write re-joins only the chunk holding the post it changed, and serving
+# the listing is a matter of concatenating the chunks.
+#
+# Writes in this process arrive through signals.posts_changed.  Writes made
+# by other processes are picked up by rebuilding from the database once the
+# snapshot is SNAPSHOT_MAX_AGE seconds old.  That happens on a thread of its
+# own, with requests served from the old chunks meanwhile, and is skipped
+# when the table's row count, highest id, total of versions and newest
+# updated_at all show nothing has changed.  Tables of more than
+# SNAPSHOT_MAX_ROWS posts are not kept at all.
+
+class Chunk(object):
+    ''' the serialized posts in one range of ids '''
+    def __init__(self):
+        self.rows = {}
+        self.data = b''
+        self.digest = b''
+
+    def refresh(self):
+        self.data = b','.join(self.rows[id] for id in sorted(self.rows))
+        self.digest = hashlib.sha1(self.data).digest()
+
+class ListingSnapshot(object):
+    def __init__(self, page_size, max_age, max_rows):
+        self.page_size = page_size
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # bumped so a rebuild running across a reset is thrown away
+            self.generation += 1
+            # chunk number -> Chunk, or None when the table is too large
+            self.chunks = None
+            self.built_at = None
+            # summary of the table when it was last read, see summarize
+            self.summary = None
+            # changes committed while a rebuild is reading the table
+            self.pending = None
+            self.body = None
+            self.etag = None
+
+    def fresh(self):
+        return (self.built_at is not None and
+                time.monotonic() - self.built_at < self.max_age)
+
+    def apply(self, chunks, posts, deleted):
+        ''' write changed posts into chunks, re-joining only those touched '''
+        touched = set()
+        for post in posts:
+            number = (post['id'] - 1) // self.page_size
+            chunk = chunks.get(number)
+            if chunk is None:
+                chunk = chunks[number] = Chunk()
+            chunk.rows[post['id']] = dumps({'id': post['id'], 'title': post['title'],
+                                            'body': post['body']})
+            touched.add(number)
+        for id in deleted:
+            number = (id - 1) // self.page_size
+            chunk = chunks.get(number)
+            if chunk is not None and chunk.rows.pop(id, None) is not None:
+                touched.add(number)
+        for number in touched:
+            chunks[number].refresh()
+            if not chunks[number].rows:
+                del chunks[number]
+
+    def changed(self, posts, deleted):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((posts, deleted))
+            if self.chunks is not None:
+                self.apply(self.chunks, posts, deleted)
+                self.body = None
+
+    def rebuild(self):
+        ''' read the whole table into new chunks, on this thread '''
+        with self.build_lock:
+            # another thread may have just rebuilt it
+            if self.fresh():
+                return
+            self._rebuild()
+
+    def refresh(self):
+        '''
+        Bring a stale snapshot up to date on a thread of its own, unless one
+        is already at it.  Requests carry on with the old chunks meanwhile.
+        '''
+        if self.fresh() or not self.build_lock.acquire(blocking = False):
+            return
+        def build():
+            try:
+                self._rebuild()
+            finally:
+                self.build_lock.release()
+        threading.Thread(target = build, name = 'posts-listing-snapshot',
+                         daemon = True).start()
+
+    def _rebuild(self):
+        with self.lock:
+            generation = self.generation
+            summary = self.summary
+            self.pending = pending = []
+        try:
+            with engine.connect() as connection:
+                # read first, so writes made while reading the rows show up
+                # as a change next time
+                latest = self.summarize(connection)
+                if latest == summary:
+                    chunks = None
+                else:
+                    chunks = self.read(connection)
+        finally:
+            with self.lock:
+                self.pending = None
+        with self.lock:
+            if generation != self.generation:
+                return
+            if latest != summary:
+                if chunks is not None:
+                    for posts, deleted in pending:
+                        self.apply(chunks, posts, deleted)
+                self.chunks = chunks
+                self.body = None
+            self.summary = latest
+            self.built_at = time.monotonic()
+
+    def summarize(self, connection):
+        '''
+        One aggregate over the table which changes with any insert, update
+        (versions only go up) or delete, far cheaper than reading the rows
+        '''
+        table = models.Post.__table__
+        statement = select(func.count(), func.max(table.c.id),
+                           func.sum(table.c.version), func.max(table.c.updated_at))
+        return tuple(connection.execute(statement).one())
+
+    def read(self, connection):
+        ''' the table in chunks, or None if it has more than max_rows posts '''
+        table = models.Post.__table__
+        statement = select(table.c.id, table.c.title, table.c.body).order_by(table.c.id)
+        chunks = {}
+        count = 0
+        rows = connection.execution_options(yield_per = self.page_size)
+        for partition in rows.execute(statement).partitions():
+            count += len(partition)
+            if count > self.max_rows:
+                return None
+            self.apply(chunks, [row._asdict() for row in partition], ())
+        return chunks
+
+    def get(self):
+        '''
+        The serialized listing and its entity tag.  None when the table is
+        too large to keep.  Only the first build is waited for; after that
+        a stale snapshot is served while it is refreshed in the background.
+        '''
+        if self.built_at is None:
+            self.rebuild()
+        elif not self.fresh():
+            self.refresh()
+        with self.lock:
+            if self.chunks is None:
+                return None
+            if self.body is None:
+                chunks = [self.chunks[number] for number in sorted(self.chunks)]
+                self.body = b'[' + b','.join(chunk.data for chunk in chunks) + b']'
+                digests = b''.join(chunk.digest for chunk in chunks)
+                self.etag = hashlib.sha1(digests).hexdigest()
+            return self.body, self.etag
+
+listing = ListingSnapshot(app.config['SNAPSHOT_PAGE_SIZE'],
+                          app.config['SNAPSHOT_MAX_AGE'],
+                          app.config['SNAPSHOT_MAX_ROWS'])
+
+def enabled():
+    return app.config['SNAPSHOT_ENABLED']
+
+def usable():
+    ''' whether the current request is for the plain listing '''
+    return enabled() and not request.args
+
+def preload():
+    ''' build the snapshot before serving, if SNAPSHOT_PRELOAD is set '''
+    if enabled() and app.config['SNAPSHOT_PRELOAD']:
+        listing.rebuild()
+
+@signals.posts_changed.connect
+def update_snapshot(sender, created = (), updated = (), deleted = ()):
+    listing.changed(list(created) + list(updated), list(deleted))
+
+# recreating or dropping the table invalidates the snapshot
+event.listen(models.Post.__table__, 'after_create', lambda *args, **kw: listing.reset())
+event.listen(models.Post.__table__, 'after_drop', lambda *args, **kw: listing.reset())
@@ -0,0 +1,224 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import request, Response, url_for
+from sqlalchemy import event, insert
+
+from . import decorators
+from . import models
+from . import signals
+from posts import app
+from .database import Session
+from .serializers import dumps
+
+# Write-behind for POST /api/posts, switched on with WRITE_BEHIND.  Validated
+# posts are queued and a background thread inserts them in group commits of
+# up to WRITE_BATCH_SIZE posts, waiting at most WRITE_BATCH_DELAY seconds for
+# a batch to fill, so many requests share the cost of one commit.
+#
+# Clients sending "Prefer: respond-async" get a 202 straight away with a
+# status URL for their post.  Everyone else waits until the batch holding
+# their post has committed and gets the usual 201, so a client which waits
+# has the same guarantee as before, for up to WRITE_WAIT_TIMEOUT seconds;
+# after that they get a 503 pointing at the status URL instead.
+
+class PendingPost(object):
+    ''' a post waiting in the queue, and what became of it '''
+    def __init__(self, title, body):
+        self.ticket = uuid.uuid4().hex
+        self.title = title
+        self.body = body
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, id = None, error = None):
+        self.id = id
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout = None):
+        ''' wait for the post's batch; whether it finished in time '''
+        return self.done.wait(timeout)
+
+class WriteQueue(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        # recent tickets, for the status endpoint
+        self.tickets = OrderedDict()
+
+    def start(self):
+        # a forked worker inherits the queue but not the thread, so each
+        # process starts its own on first use
+        self.queue = queue.Queue(app.config['WRITE_QUEUE_SIZE'])
+        self.pid = os.getpid()
+        self.tickets.clear()
+        self.start_thread()
+
+    def start_thread(self):
+        self.thread = threading.Thread(target = self.run, args = (self.queue,),
+                                       name = 'posts-write-behind', daemon = True)
+        self.thread.start()
+
+    def submit(self, title, body):
+        '''
+        Queue a post for the next group commit.  Raises queue.Full when the
+        queue is at WRITE_QUEUE_SIZE.
+        '''
+        pending = PendingPost(title, body)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start()
+            elif not self.thread.is_alive():
+                # whatever killed it, the posts already queued are kept
+                app.logger.warning('Restarting the write-behind thread')
+                self.start_thread()
+            self.queue.put_nowait(pending)
+            self.tickets[pending.ticket] = pending
+            while len(self.tickets) > app.config['WRITE_QUEUE_SIZE']:
+                self.tickets.popitem(last = False)
+        return pending
+
+    def ticket(self, ticket):
+        with self.lock:
+            return self.tickets.get(ticket)
+
+    def run(self, pending):
+        while True:
+            batch = [pending.get()]
+            stop = batch[0] is None
+            deadline = time.monotonic() + app.config['WRITE_BATCH_DELAY']
+            while not stop and len(batch) < app.config['WRITE_BATCH_SIZE']:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = pending.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                stop = item is None
+                batch.append(item)
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self.flush(batch)
+            if stop:
+                return
+
+    def flush(self, batch):
+        ''' insert a batch of posts in one transaction '''
+        rows = [{'title': post.title, 'body': post.body} for post in batch]
+        statement = insert(models.Post).returning(models.Post.id,
+                                                  sort_by_parameter_order = True)
+        session = Session()
+        session.info['write_behind_committed'] = False
+        ids = []
+        try:
+            ids = session.scalars(statement, rows).all()
+            for row, id in zip(rows, ids):
+                row['id'] = id
+            signals.stage_post_changes(session, created = rows)
+            session.commit()
+        except Exception:
+            # anything raised here would end the thread, and with it every
+            # later post; an error after the commit, from a posts_changed
+            # receiver, still leaves the posts saved
+            app.logger.exception('Write-behind batch of %d posts failed', len(batch))
+            if not session.info['write_behind_committed']:
+                session.rollback()
+                ids = []
+        finally:
+            session.close()
+            for index, post in enumerate(batch):
+                if index < len(ids):
+                    post.finish(id = ids[index])
+                else:
+                    post.finish(error = 'The post could not be saved')
+
+    def close(self):
+        ''' write out whatever is queued, on shutdown '''
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.queue.put(None)
+            thread = self.thread
+        thread.join(timeout = 10)
+
+@event.listens_for(Session, 'after_commit', insert = True)
+def note_commit(session):
+    # ahead of the posts_changed announcement, which may raise
+    if 'write_behind_committed' in session.info:
+        session.info['write_behind_committed'] = True
+
+write_queue = WriteQueue()
+atexit.register(write_queue.close)
+
+def enabled():
+    return app.config['WRITE_BEHIND']
+
+def respond_async():
+    ''' whether the client asked for a 202 with "Prefer: respond-async" '''
+    preferences = request.headers.get('Prefer', '').split(',')
+    return 'respond-async' in [preference.split(';')[0].strip()
+                               for preference in preferences]
+
+def queue_full_response():
+    data = dumps({'message': 'Too many posts are waiting to be saved'})
+    return Response(data, 503, headers = {'Retry-After': '1'},
+                    mimetype = 'application/json')
+
+def wait_timeout_response(pending):
+    ''' 503 for a post still queued after WRITE_WAIT_TIMEOUT, with its status URL '''
+    data = dumps({'message': 'The post is still waiting to be saved',
+                  'status': 'pending', 'ticket': pending.ticket})
+    headers = {
+        'Location': url_for('write_status', ticket = pending.ticket),
+        'Retry-After': '1'
+    }
+    return Response(data, 503, headers = headers, mimetype = 'application/json')
+
+def accepted_response(pending):
+    ''' 202 Accepted, pointing at the status of the queued post '''
+    data = dumps({'status': 'pending', 'ticket': pending.ticket})
+    headers = {
+        'Location': url_for('write_status', ticket = pending.ticket),
+        'Preference-Applied': 'respond-async'
+    }
+    return Response(data, 202, headers = headers, mimetype = 'application/json')
+
+def created_response(pending):
+    ''' 201 Created once the post's batch has committed, as posts_post does '''
+    if not pending.done.is_set():
+        return wait_timeout_response(pending)
+    if pending.error:
+        data = dumps({'message': pending.error})
+        return Response(data, 500, mimetype = 'application/json')
+    data = dumps({'id': pending.id, 'title': pending.title, 'body': pending.body})
+    headers = {'Location': url_for('post_get', id = pending.id)}
+    return Response(data, 201, headers = headers, mimetype = 'application/json')
+
+@app.route('/api/posts/_queue/<ticket>', methods = ['GET'])
+@decorators.accept('application/json')
+def write_status(ticket):
+    ''' whether a post queued with "Prefer: respond-async" has been saved '''
+    pending = write_queue.ticket(ticket)
+    if pending is None:
+        message = 'Could not find queued post {}'.format(ticket)
+        data = dumps({'message': message})
+        return Response(data, 404, mimetype = 'application/json')
+    if not pending.done.is_set():
+        data = dumps({'status': 'pending', 'ticket': ticket})
+        return Response(data, 200, mimetype = 'application/json')
+    if pending.error:
+        data = dumps({'status': 'failed', 'ticket': ticket, 'message': pending.error})
+        return Response(data, 200, mimetype = 'application/json')
+    data = dumps({'status': 'created', 'ticket': ticket, 'id': pending.id})
+    headers = {'Location': url_for('post_get', id = pending.id)}
+    return Response(data, 200, headers = headers, mimetype = 'application/json')
@@ -1,10 +1,29 @@
 import os
+import sys
 from posts import app
 
 def run():
+    from posts import snapshot
+    snapshot.preload()
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port)
+    app.run(host='0.0.0.0', port=port, threaded=True)
 
-if __name__ == '__main__':
-    run()
+def run_production():
+    # pre-forks WORKERS processes sharing one socket; see posts.server
+    from posts import server
+    port = int(os.environ.get('PORT', 8080))
+    server.serve(app, '0.0.0.0', port)
 
+def run_async():
+    # serves posts.asgi, which needs uvicorn and asyncpg (or aiosqlite)
+    import uvicorn
+    port = int(os.environ.get('PORT', 8080))
+    uvicorn.run('posts.asgi:application', host='0.0.0.0', port=port)
+
+if __name__ == '__main__':
+    if '--async' in sys.argv:
+        run_async()
+    elif '--production' in sys.argv:
+        run_production()
+    else:
+        run()
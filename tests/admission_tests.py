@@ -0,0 +1,105 @@
+import unittest
+import asyncio
+import os
+import json
+import threading
+import time
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import admission
+from posts import app
+from posts.admission import ConcurrencyLimit, LocalBuckets
+from fixtures import DatabaseTestCase
+
+class TestAdmission(DatabaseTestCase):
+    """ Tests for rate limiting and the concurrency limit """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        self.concurrency = admission.concurrency
+        self.buckets = admission.buckets
+        admission.buckets = LocalBuckets()
+        super().setUp()
+
+    def tearDown(self):
+        """ Test teardown """
+        admission.concurrency = self.concurrency
+        admission.buckets = self.buckets
+        app.config['RATE_LIMIT'] = 0
+        super().tearDown()
+        
+    def get_posts(self):
+        return self.client.get('/api/posts',
+            headers = [('Accept', 'application/json')]
+        )
+        
+    def test_rate_limit(self):
+        ''' clients over their rate limit get a 429 '''
+        app.config['RATE_LIMIT'] = 0.5
+        app.config['RATE_LIMIT_BURST'] = 2
+        
+        self.assertEqual(self.get_posts().status_code, 200)
+        self.assertEqual(self.get_posts().status_code, 200)
+        response = self.get_posts()
+        
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Rate limit exceeded')
+        
+    def test_token_bucket_refills(self):
+        buckets = LocalBuckets()
+        self.assertEqual(buckets.take('client', 100, 1), (True, 0))
+        allowed, wait = buckets.take('client', 100, 1)
+        self.assertFalse(allowed)
+        self.assertLessEqual(wait, 0.01)
+        
+        time.sleep(0.02)
+        self.assertEqual(buckets.take('client', 100, 1), (True, 0))
+        # other clients have buckets of their own
+        self.assertEqual(buckets.take('other', 100, 1), (True, 0))
+        
+    def test_concurrency_limit(self):
+        ''' requests beyond the concurrency limit get a 503 '''
+        admission.concurrency = ConcurrencyLimit(1, 0)
+        self.assertEqual(self.get_posts().status_code, 200)
+        
+        # the slot was given back when the response finished
+        self.assertTrue(admission.concurrency.acquire(0))
+        response = self.get_posts()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        
+    def test_concurrency_queue(self):
+        ''' queued requests run once a slot comes free '''
+        admission.concurrency = ConcurrencyLimit(1, 1)
+        admission.concurrency.acquire(0)
+        threading.Timer(0.05, admission.concurrency.release).start()
+        
+        self.assertEqual(self.get_posts().status_code, 200)
+        
+    def test_concurrency_queue_async(self):
+        ''' async requests wait on their event loop for a slot '''
+        concurrency = ConcurrencyLimit(1, 2)
+        concurrency.acquire(0)
+        
+        async def wait():
+            threading.Timer(0.05, concurrency.release).start()
+            return await asyncio.gather(concurrency.acquire_async(1),
+                                        concurrency.acquire_async(0.1))
+        # the first waiter is handed the released slot, the second gives up
+        self.assertEqual(asyncio.run(wait()), [True, False])
+        self.assertFalse(concurrency.waiters)
+        
+        # a waiter which gave up doesn't keep the slot from anyone else
+        async def give_up():
+            self.assertFalse(await concurrency.acquire_async(0.01))
+        asyncio.run(give_up())
+        concurrency.release()
+        self.assertTrue(concurrency.acquire(0))
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -1,31 +1,37 @@
 import unittest
 import os
 import json
+import gzip
+import time
+import threading
 try: from urllib.parse import urlparse
 except ImportError: from urlparse import urlparse # Python 2 compatibility
 
+import msgpack
+
 # Configure our app to use the testing databse
 os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
 
 from posts import app
+from posts import api
 from posts import models
-from posts.database import Base, engine, session
+from posts import search
+from posts import signals
+from posts import snapshot
+from posts import writebehind
+from posts.cache import post_cache, LocalBackend
+from posts.coalesce import SingleFlight
+from posts.decorators import encoded_bodies
+from posts.database import engine, session, engine_options
+from fixtures import DatabaseTestCase, committed
 
-class TestAPI(unittest.TestCase):
+class TestAPI(DatabaseTestCase):
     """ Tests for the posts API """
 
     def setUp(self):
         """ Test setup """
+        super().setUp()
         self.client = app.test_client()
-
-        # Set up the tables in the database
-        Base.metadata.create_all(engine)
-
-    def tearDown(self):
-        """ Test teardown """
-        session.close()
-        # Remove the tables and their data from the database
-        Base.metadata.drop_all(engine)
         
     def test_get_empty_posts(self):
         ''' getting posts from an empty database '''
@@ -390,6 +396,22 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data.decode('ascii'))
         self.assertEqual(data['message'], '32 is not of type \'string\'')
         
+    def test_post_put_not_object(self):
+        ''' a post must be a JSON object '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        data = json.dumps([{'title': 'Example Post', 'body': 'Just a test'}])
+        for method, path in (('POST', '/api/posts'), ('PUT', '/api/posts/1')):
+            response = self.client.open(path, method = method, data = data,
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 422)
+            message = json.loads(response.data.decode('ascii'))['message']
+            self.assertTrue(message.endswith('is not of type \'object\''))
+        
     def test_put_missing_data(self):
         ''' posting a post with a missing body '''
         data = {
@@ -407,5 +429,1131 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data.decode('ascii'))
         self.assertEqual(data['message'], '\'body\' is a required property')
         
+    def test_get_posts_paginated(self):
+        ''' paging through posts with limit and after_id '''
+        posts = [models.Post(title = 'Post {}'.format(i), body = 'A test')
+                 for i in range(5)]
+        session.add_all(posts)
+        session.commit()
+        
+        response = self.client.get('/api/posts?limit=2',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual([post['title'] for post in data], ['Post 0', 'Post 1'])
+        
+        # follow the next links until the last page
+        titles = [post['title'] for post in data]
+        while 'Link' in response.headers:
+            link = response.headers['Link']
+            self.assertTrue(link.endswith('; rel="next"'))
+            url = urlparse(link[1:link.index('>')])
+            response = self.client.get('{}?{}'.format(url.path, url.query),
+                headers = [('Accept', 'application/json')]
+            )
+            data = json.loads(response.data.decode('ascii'))
+            titles.extend(post['title'] for post in data)
+        
+        self.assertEqual(titles, ['Post {}'.format(i) for i in range(5)])
+        
+    def test_get_posts_invalid_limit(self):
+        response = self.client.get('/api/posts?limit=zero',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'limit must be a positive integer')
+        
+    def test_get_posts_streamed(self):
+        ''' streaming posts as a chunked JSON array '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        response = self.client.get('/api/posts?stream=true&title_like=B',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['title'], 'Example Post B')
+        
+    def test_get_empty_posts_streamed(self):
+        response = self.client.get('/api/posts?stream=true',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data, [])
+        
+    def test_get_posts_with_search_terms(self):
+        ''' token prefix search over titles and bodies '''
+        postA = models.Post(title = "Post with bells", body = "Just a test")
+        postB = models.Post(title = "Post with whistles", body = "Still a test")
+        postC = models.Post(title = "Post with bells and whistles",
+                            body = "Another test")
+
+        session.add_all([postA, postB, postC])
+        session.commit()
+
+        response = self.client.get("/api/posts?q=whis",
+            headers=[("Accept", "application/json")]
+        )
+        posts = json.loads(response.data.decode("ascii"))
+        self.assertEqual([post["title"] for post in posts],
+            ["Post with whistles", "Post with bells and whistles"])
+
+        response = self.client.get("/api/posts?q=Bell+anoth",
+            headers=[("Accept", "application/json")]
+        )
+        posts = json.loads(response.data.decode("ascii"))
+        self.assertEqual([post["title"] for post in posts],
+            ["Post with bells and whistles"])
+
+    def test_get_posts_with_title_after_update(self):
+        ''' filters see posts changed through the API '''
+        postA = models.Post(title = "Post with bells", body = "Just a test")
+        session.add(postA)
+        session.commit()
+
+        # build the search index before changing the post
+        response = self.client.get("/api/posts?title_like=bells",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(len(json.loads(response.data.decode("ascii"))), 1)
+
+        data = {"title": "Post with whistles", "body": "Just a test"}
+        self.client.put("/api/posts/{}".format(postA.id),
+            data = json.dumps(data),
+            content_type = "application/json",
+            headers = [("Accept", "application/json")]
+        )
+
+        response = self.client.get("/api/posts?title_like=bells",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(json.loads(response.data.decode("ascii")), [])
+
+        response = self.client.get("/api/posts?title_like=WHISTLE&q=whis",
+            headers=[("Accept", "application/json")]
+        )
+        posts = json.loads(response.data.decode("ascii"))
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0]["title"], "Post with whistles")
+        
+    @committed
+    def test_get_posts_with_title_after_outside_write(self):
+        ''' the search index is rebuilt to see writes made elsewhere '''
+        max_age = search.index.max_age
+        try:
+            response = self.client.get("/api/posts?title_like=bells",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(json.loads(response.data.decode("ascii")), [])
+            
+            # inserted with Core, so no change is announced
+            with engine.begin() as connection:
+                connection.execute(models.Post.__table__.insert(),
+                                   {'title': 'Post with bells', 'body': 'Just a test',
+                                    'version': 1, 'updated_at': models.utcnow()})
+            response = self.client.get("/api/posts?title_like=bells",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(json.loads(response.data.decode("ascii")), [])
+            
+            # a stale index is rebuilt in the background, once any build
+            # left over from an earlier test has finished
+            search.index.max_age = 0
+            built_at = search.index.built_at
+            for attempt in range(100):
+                search.index.ensure_built()
+                with search.index.build_lock:
+                    if search.index.built_at != built_at:
+                        search.index.max_age = max_age
+                        break
+            response = self.client.get("/api/posts?title_like=bells&q=bell",
+                headers=[("Accept", "application/json")]
+            )
+            posts = json.loads(response.data.decode("ascii"))
+            self.assertEqual([post["title"] for post in posts], ["Post with bells"])
+        finally:
+            search.index.max_age = max_age
+        
+    @committed
+    def test_get_posts_with_title_over_max_rows(self):
+        ''' tables too large for the search index are searched with LIKE '''
+        session.add_all([models.Post(title = "Post with bells", body = "Just a test"),
+                         models.Post(title = "Post with whistles", body = "Still a test")])
+        session.commit()
+        
+        max_rows = search.index.max_rows
+        search.index.max_rows = 1
+        try:
+            search.index.rebuild()
+            self.assertIsNone(search.index.title_substring('whistle'))
+            self.assertIsNone(search.index.prefix(['whis']))
+            response = self.client.get("/api/posts?title_like=WHISTLE&q=whis",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            search.index.max_rows = max_rows
+        posts = json.loads(response.data.decode("ascii"))
+        self.assertEqual([post["title"] for post in posts], ["Post with whistles"])
+        
+    def test_get_posts_with_common_title(self):
+        ''' terms matching many posts are filtered without the index '''
+        session.add_all([models.Post(title = "Post with bells", body = "Just a test"),
+                         models.Post(title = "Post with whistles", body = "Still a test")])
+        session.commit()
+        
+        max_candidates = app.config['SEARCH_MAX_CANDIDATES']
+        app.config['SEARCH_MAX_CANDIDATES'] = 1
+        try:
+            statement = search.filter_contains(session.query(models.Post), models.Post.title, 'Post')
+            self.assertNotIn('json_each', str(statement))
+            response = self.client.get("/api/posts?title_like=post+with+w",
+                headers=[("Accept", "application/json")]
+            )
+        finally:
+            app.config['SEARCH_MAX_CANDIDATES'] = max_candidates
+        posts = json.loads(response.data.decode("ascii"))
+        self.assertEqual([post["title"] for post in posts], ["Post with whistles"])
+        
+    def test_session_removed_after_request(self):
+        ''' every request gets a fresh session '''
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(session.registry.has())
+        
+    def test_engine_pool_options(self):
+        config = dict(app.config, DATABASE_URI = 'postgresql://localhost/posts',
+                      POOL_SIZE = 20, MAX_OVERFLOW = 5)
+        options = engine_options(config)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 5)
+        
+        config['DATABASE_URI'] = 'sqlite://'
+        self.assertNotIn('pool_size', engine_options(config))
+        
+    def test_get_post_cached(self):
+        ''' repeated reads of a post are served from the cache '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        id = postA.id
+        post_cache.clear()
+        
+        before = post_cache.stats()
+        for i in range(3):
+            response = self.client.get('/api/posts/{}'.format(id),
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 200)
+        after = post_cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        
+        response = self.client.get('/api/cache',
+            headers = [('Accept', 'application/json')]
+        )
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['hits'], after['hits'])
+        
+    def test_cached_post_invalidated_by_writes(self):
+        data = {'title': 'Example Post', 'body': 'Just a test'}
+        response = self.client.post('/api/posts',
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        location = urlparse(response.headers.get('Location')).path
+        self.client.get(location, headers = [('Accept', 'application/json')])
+        
+        data = {'title': 'Changed Title', 'body': 'And changed body.'}
+        self.client.put(location,
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        response = self.client.get(location,
+            headers = [('Accept', 'application/json')]
+        )
+        post = json.loads(response.data.decode('ascii'))
+        self.assertEqual(post['title'], 'Changed Title')
+        
+        self.client.delete(location, headers = [('Accept', 'application/json')])
+        response = self.client.get(location,
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 404)
+        
+    def test_cache_fill_after_invalidation(self):
+        ''' a read racing a write can't put the old post back in the cache '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        id = postA.id
+        
+        # read before the update, stored after it
+        token = post_cache.token(id)
+        stale = api.CachedPost(postA.version, postA.updated_at, b'{}')
+        data = {'title': 'Changed Title', 'body': 'And changed body.'}
+        self.client.put('/api/posts/{}'.format(id),
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertFalse(post_cache.fill(id, stale, token))
+        self.assertIsNone(post_cache.get(id))
+        
+        response = self.client.get('/api/posts/{}'.format(id),
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(json.loads(response.data.decode('ascii'))['title'],
+                         'Changed Title')
+        self.assertEqual(post_cache.get(id).version, 2)
+        
+    def test_local_cache_eviction(self):
+        ''' the local backend evicts least recently used and expired keys '''
+        backend = LocalBackend(max_entries = 2)
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+        backend.get('a')
+        backend.set('c', b'3')
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertIsNone(backend.get('b'))
+        
+        backend.set('d', b'4', ex = 0.001)
+        time.sleep(0.01)
+        self.assertIsNone(backend.get('d'))
+        
+    def test_single_flight(self):
+        ''' concurrent calls with the same key share one result '''
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+        def load():
+            calls.append(1)
+            release.wait()
+            return b'data'
+        
+        results = []
+        threads = [threading.Thread(target = lambda: results.append(flight.do('key', load)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [(b'data', False)] + [(b'data', True)] * 4)
+        # the next call runs afresh
+        self.assertEqual(flight.do('key', load), (b'data', False))
+        
+    def test_single_flight_forget(self):
+        ''' calls after a write don't join one started before it '''
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        def load():
+            started.set()
+            release.wait()
+            return 'before'
+        
+        thread = threading.Thread(target = flight.do, args = ('key', load))
+        thread.start()
+        started.wait()
+        flight.forget()
+        self.assertEqual(flight.do('key', lambda: 'after'), ('after', False))
+        release.set()
+        thread.join()
+        
+    def test_get_post_conditional(self):
+        ''' revalidating a post with its ETag and Last-Modified '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        url = '/api/posts/{}'.format(postA.id)
+        
+        response = self.client.get(url, headers = [('Accept', 'application/json')])
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(last_modified)
+        
+        # served from the database and then from the cache alike
+        post_cache.clear()
+        for i in range(2):
+            response = self.client.get(url,
+                headers = [('Accept', 'application/json'),
+                           ('If-None-Match', etag)]
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+        
+        response = self.client.get(url,
+            headers = [('Accept', 'application/json'),
+                       ('If-Modified-Since', last_modified)]
+        )
+        self.assertEqual(response.status_code, 304)
+        
+        data = {'title': 'Changed Title', 'body': 'And changed body.'}
+        response = self.client.put(url,
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+        
+        response = self.client.get(url,
+            headers = [('Accept', 'application/json'), ('If-None-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        
+    def test_get_posts_conditional(self):
+        ''' revalidating a list of posts '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/json')]
+        )
+        etag = response.headers.get('ETag')
+        
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/json'), ('If-None-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 304)
+        
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        session.add(postB)
+        session.commit()
+        
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/json'), ('If-None-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data.decode('ascii'))), 2)
+        
+    def test_get_posts_conditional_after_delete(self):
+        ''' listings are validated by ETag, which deletes change '''
+        session.add_all([models.Post(title = 'Example Post A', body = 'Just a test'),
+                         models.Post(title = 'Example Post B', body = 'Still a test')])
+        session.commit()
+        
+        for query in ('', '?limit=10'):
+            response = self.client.get('/api/posts' + query,
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertNotIn('Last-Modified', response.headers)
+        etag = response.headers.get('ETag')
+        
+        self.client.delete('/api/posts/1', headers = [('Accept', 'application/json')])
+        
+        response = self.client.get('/api/posts?limit=10',
+            headers = [('Accept', 'application/json'),
+                       ('If-Modified-Since', 'Fri, 01 Jan 2100 00:00:00 GMT')]
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/posts?limit=10',
+            headers = [('Accept', 'application/json'), ('If-None-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data.decode('ascii'))), 1)
+        
+    def test_get_posts_snapshot(self):
+        ''' writes update only their chunk of the listing snapshot '''
+        listing = snapshot.listing
+        page_size = listing.page_size
+        listing.page_size = 2
+        try:
+            session.add_all([models.Post(title = 'Example Post {}'.format(i),
+                                         body = 'Just a test') for i in range(5)])
+            session.commit()
+            
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual([post['id'] for post in data], [1, 2, 3, 4, 5])
+            self.assertEqual(sorted(listing.chunks), [0, 1, 2])
+            first, last = listing.chunks[0], listing.chunks[2]
+            etag = response.headers.get('ETag')
+            
+            data = {'title': 'Example Post 2', 'body': 'Updated'}
+            self.client.put('/api/posts/3', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.client.delete('/api/posts/5',
+                headers = [('Accept', 'application/json')]
+            )
+            # the first chunk is untouched, the emptied one is dropped
+            self.assertEqual(listing.chunks[0].data, first.data)
+            self.assertNotIn(2, listing.chunks)
+            self.assertEqual(last.rows, {})
+            
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json'), ('If-None-Match', etag)]
+            )
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual([post['id'] for post in data], [1, 2, 3, 4])
+            self.assertEqual(data[2]['body'], 'Updated')
+            
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json'),
+                           ('If-None-Match', response.headers.get('ETag'))]
+            )
+            self.assertEqual(response.status_code, 304)
+        finally:
+            listing.page_size = page_size
+        
+    @committed
+    def test_get_posts_snapshot_stale(self):
+        ''' the snapshot is rebuilt to see writes made elsewhere '''
+        listing = snapshot.listing
+        max_age = listing.max_age
+        try:
+            self.client.get('/api/posts', headers = [('Accept', 'application/json')])
+            
+            # inserted with Core, so no change is announced
+            with engine.begin() as connection:
+                connection.execute(models.Post.__table__.insert(),
+                                   {'title': 'Example Post A', 'body': 'Just a test',
+                                    'version': 1, 'updated_at': models.utcnow()})
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(json.loads(response.data.decode('ascii')), [])
+            
+            # a stale snapshot is still served while it is rebuilt
+            listing.max_age = 0
+            built_at = listing.built_at
+            for attempt in range(100):
+                response = self.client.get('/api/posts',
+                    headers = [('Accept', 'application/json')]
+                )
+                self.assertEqual(response.status_code, 200)
+                with listing.build_lock:
+                    if listing.built_at != built_at:
+                        listing.max_age = max_age
+                        break
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json')]
+            )
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual([post['title'] for post in data], ['Example Post A'])
+        finally:
+            listing.max_age = max_age
+        
+    @committed
+    def test_get_posts_snapshot_unchanged(self):
+        ''' a stale snapshot of an unchanged table isn't read again '''
+        listing = snapshot.listing
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.commit()
+        listing.built_at = None
+        listing.rebuild()
+        chunks = listing.chunks
+        
+        # reading the rows again would fail
+        read = listing.read
+        listing.read = None
+        try:
+            listing.built_at -= listing.max_age
+            listing.rebuild()
+        finally:
+            listing.read = read
+        self.assertIs(listing.chunks, chunks)
+        self.assertTrue(listing.fresh())
+        
+        # while a change made elsewhere is
+        with engine.begin() as connection:
+            connection.execute(models.Post.__table__.update(), {'title': 'Changed Title'})
+        listing.built_at -= listing.max_age
+        listing.rebuild()
+        response = self.client.get('/api/posts', headers = [('Accept', 'application/json')])
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual([post['title'] for post in data], ['Changed Title'])
+        
+    @committed
+    def test_get_posts_snapshot_too_large(self):
+        ''' tables larger than SNAPSHOT_MAX_ROWS are listed from the database '''
+        listing = snapshot.listing
+        max_rows = listing.max_rows
+        listing.max_rows = 1
+        listing.reset()
+        try:
+            session.add_all([models.Post(title = 'Example Post A', body = 'Just a test'),
+                             models.Post(title = 'Example Post B', body = 'Still a test')])
+            session.commit()
+            
+            response = self.client.get('/api/posts',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertIsNone(listing.chunks)
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual(len(data), 2)
+        finally:
+            listing.max_rows = max_rows
+            listing.reset()
+        
+    def test_put_if_match(self):
+        ''' optimistic concurrency control with If-Match '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        url = '/api/posts/{}'.format(postA.id)
+        
+        response = self.client.get(url, headers = [('Accept', 'application/json')])
+        etag = response.headers.get('ETag')
+        
+        data = {'title': 'Changed Title', 'body': 'And changed body.'}
+        response = self.client.put(url,
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json'), ('If-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+        post = json.loads(response.data.decode('ascii'))
+        self.assertEqual(post['title'], 'Changed Title')
+        
+        # a second editor still holding the old tag is turned away
+        data = {'title': 'Other Title', 'body': 'Other body.'}
+        response = self.client.put(url,
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json'), ('If-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 412)
+        
+        response = self.client.get(url, headers = [('Accept', 'application/json')])
+        post = json.loads(response.data.decode('ascii'))
+        self.assertEqual(post['title'], 'Changed Title')
+        
+    def test_patch_post(self):
+        ''' changing only some fields of a post '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        url = '/api/posts/{}'.format(postA.id)
+        etag = '"{}-1"'.format(postA.id)
+        
+        data = {'title': 'Changed Title'}
+        response = self.client.patch(url,
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json'), ('If-Match', etag)]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('ETag'), '"1-2"')
+        post = json.loads(response.data.decode('ascii'))
+        self.assertEqual(post, {'id': 1, 'title': 'Changed Title', 'body': 'Just a test'})
+        
+        session.expire_all()
+        postA = session.get(models.Post, 1)
+        self.assertEqual(postA.title, 'Changed Title')
+        self.assertEqual(postA.body, 'Just a test')
+        
+        # the old tag no longer matches
+        response = self.client.patch(url,
+            data = json.dumps({'body': 'Changed body'}),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json'), ('If-Match', etag)]
+        )
+        self.assertEqual(response.status_code, 412)
+        
+    def test_patch_invalid_data(self):
+        ''' patches must change a field, with valid values '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        for data in ({}, {'title': 32}, {'body': 'x' * 1025}):
+            response = self.client.patch('/api/posts/1',
+                data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 422)
+        
+        # a patch changing nothing is told which fields it can change
+        for data in ({}, {'tilte': 'Changed Title'}):
+            response = self.client.patch('/api/posts/1',
+                data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            message = json.loads(response.data.decode('ascii'))['message']
+            self.assertEqual(message, 'A patch must change \'title\' or \'body\'')
+        
+        response = self.client.patch('/api/posts/2',
+            data = json.dumps({'title': 'Changed Title'}),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Could not find post with id 2')
+        
+    def test_delete_posts(self):
+        ''' deleting posts by id and by filter in one request '''
+        postA = models.Post(title = 'Post with bells', body = 'Just a test')
+        postB = models.Post(title = 'Post with whistles', body = 'Still a test')
+        postC = models.Post(title = 'Post with bells and whistles', body = 'Another test')
+        postD = models.Post(title = 'Example Post D', body = 'Last test')
+        session.add_all([postA, postB, postC, postD])
+        session.commit()
+        
+        response = self.client.delete('/api/posts?ids=1,4,99',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('ascii')), {'deleted': 2})
+        
+        response = self.client.delete('/api/posts?title_like=whistles',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('ascii')), {'deleted': 2})
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+        response = self.client.get('/api/posts?title_like=bells',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(json.loads(response.data.decode('ascii')), [])
+        
+    def test_delete_posts_needs_filter(self):
+        ''' a bulk delete never removes every post by accident '''
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.commit()
+        
+        for path in ('/api/posts', '/api/posts?ids=1,x'):
+            response = self.client.delete(path,
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(session.query(models.Post).count(), 1)
+        
+    def test_bulk_posts(self):
+        ''' creating, updating and deleting posts in one request '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        session.add_all([postA, postB])
+        session.commit()
+        
+        data = [
+            {'title': 'Example Post C', 'body': 'Another test'},
+            {'op': 'update', 'id': postA.id, 'title': 'Changed Title',
+             'body': 'And changed body.'},
+            {'op': 'delete', 'id': postB.id},
+            {'op': 'delete', 'id': 99}
+        ]
+        response = self.client.post('/api/posts/_bulk',
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode('ascii'))
+        self.assertEqual([result['status'] for result in results],
+            [201, 200, 200, 404])
+        
+        posts = session.query(models.Post).order_by(models.Post.id).all()
+        self.assertEqual([post.title for post in posts],
+            ['Changed Title', 'Example Post C'])
+        self.assertEqual(posts[1].id, results[0]['id'])
+        
+    def test_bulk_posts_ndjson(self):
+        data = '\n'.join(json.dumps({'title': 'Post {}'.format(i), 'body': 'A test'})
+                         for i in range(3))
+        response = self.client.post('/api/posts/_bulk',
+            data = data,
+            content_type = 'application/x-ndjson',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.query(models.Post).count(), 3)
+        
+    def test_bulk_posts_invalid_item(self):
+        ''' a single invalid item rejects the whole batch '''
+        data = [
+            {'title': 'Example Post', 'body': 'Just a test'},
+            {'title': 'Example Post', 'body': 32}
+        ]
+        response = self.client.post('/api/posts/_bulk',
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 422)
+        results = json.loads(response.data.decode('ascii'))
+        self.assertEqual(results[1]['message'], '32 is not of type \'string\'')
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+    def test_post_oversized_data(self):
+        ''' posting a post longer than the database allows '''
+        data = {
+            'title': 'x' * 129,
+            'body': 'Just a test'
+        }
+        
+        response = self.client.post('/api/posts',
+            data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 422)
+        
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], '\'{}\' is too long'.format('x' * 129))
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+    def test_get_posts_with_fields(self):
+        ''' projecting posts onto some of their fields '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        session.add_all([postA, postB])
+        session.commit()
+        
+        for stream in ('false', 'true'):
+            response = self.client.get(
+                '/api/posts?fields=id,title&stream={}'.format(stream),
+                headers = [('Accept', 'application/json')]
+            )
+            
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual(data, [
+                {'id': postA.id, 'title': 'Example Post A'},
+                {'id': postB.id, 'title': 'Example Post B'}
+            ])
+        
+        response = self.client.get('/api/posts?fields=id,author',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Unknown field author')
+        
+    def test_count_posts(self):
+        ''' counting the matching posts without listing them '''
+        postA = models.Post(title = 'Post with bells', body = 'Just a test')
+        postB = models.Post(title = 'Post with whistles', body = 'Still a test')
+        postC = models.Post(title = 'Post with bells and whistles', body = 'Another test')
+        session.add_all([postA, postB, postC])
+        session.commit()
+        
+        for count in ('only', 'estimate'):
+            response = self.client.get(
+                '/api/posts?title_like=whistles&count={}'.format(count),
+                headers = [('Accept', 'application/json')]
+            )
+            
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Total-Count'], '2')
+            data = json.loads(response.data.decode('ascii'))
+            # only Postgres can estimate; elsewhere the count is exact
+            self.assertEqual(data, {'count': 2})
+        
+        response = self.client.head('/api/posts?limit=1',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Total-Count'], '3')
+        self.assertEqual(response.data, b'')
+        
+        response = self.client.get('/api/posts?count=all',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'count must be one of only, estimate')
+        
+    def test_count_estimate_statement(self):
+        ''' estimates come from the Postgres planner '''
+        from sqlalchemy.dialects import postgresql
+        from sqlalchemy.dialects.postgresql import asyncpg
+        
+        with app.test_request_context('/api/posts?title_like=bells&count=estimate'):
+            listing = api.listing_from_request()
+            dialect = postgresql.dialect()
+            sql, parameters = api.listing_explain_statement(listing, dialect)
+            
+            self.assertTrue(api.uses_estimates(listing, dialect))
+            self.assertTrue(sql.startswith('EXPLAIN (FORMAT JSON) SELECT posts.id'))
+            self.assertIn('bells', parameters.values())
+        
+        # asyncpg takes its parameters by position
+        with app.test_request_context('/api/posts?title_like=bells&body_like=test&count=estimate'):
+            listing = api.listing_from_request()
+            dialect = asyncpg.dialect()
+            sql, parameters = api.listing_explain_statement(listing, dialect)
+            
+            self.assertIsInstance(parameters, tuple)
+            self.assertIn("posts.title LIKE '%' || $1::VARCHAR || '%'", sql)
+            self.assertIn("posts.body LIKE '%' || ${}::VARCHAR || '%'".format(len(parameters)), sql)
+            self.assertEqual((parameters[0], parameters[-1]), ('bells', 'test'))
+        
+        plan = '[{"Plan": {"Node Type": "Seq Scan", "Plan Rows": 1234}}]'
+        self.assertEqual(api.planned_rows(plan), 1234)
+        
+    def test_get_posts_msgpack(self):
+        ''' posts can be served as MessagePack instead of JSON '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/msgpack')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertIn('Accept', response.vary)
+        data = msgpack.unpackb(response.data)
+        self.assertEqual(data, [{'id': 1, 'title': 'Example Post A', 'body': 'Just a test'}])
+        
+        # JSON is preferred when the client takes either
+        response = self.client.get('/api/posts/1',
+            headers = [('Accept', 'application/msgpack, application/json')]
+        )
+        self.assertEqual(response.mimetype, 'application/json')
+        
+    def test_get_posts_compressed(self):
+        ''' large responses are gzipped for clients which accept it '''
+        session.add_all([models.Post(title = 'Example Post {}'.format(i), body = 'x' * 100)
+                         for i in range(20)])
+        session.commit()
+        
+        for path in ('/api/posts', '/api/posts?stream=true'):
+            response = self.client.get(path,
+                headers = [('Accept', 'application/json'),
+                           ('Accept-Encoding', 'gzip')]
+            )
+            
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.vary)
+            data = json.loads(gzip.decompress(response.data).decode('ascii'))
+            self.assertEqual(len(data), 20)
+        
+        # a single small post is not worth compressing
+        response = self.client.get('/api/posts/1',
+            headers = [('Accept', 'application/json'),
+                       ('Accept-Encoding', 'gzip')]
+        )
+        self.assertNotIn('Content-Encoding', response.headers)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['title'], 'Example Post 0')
+        
+    def test_representation_etags(self):
+        ''' each encoding of a response has an entity tag of its own '''
+        session.add_all([models.Post(title = 'Example Post {}'.format(i), body = 'x' * 100)
+                         for i in range(20)])
+        session.commit()
+        
+        tags = {}
+        for accept, encoding in (('application/json', 'identity'),
+                                 ('application/json', 'gzip'),
+                                 ('application/msgpack', 'identity'),
+                                 ('application/msgpack', 'gzip')):
+            headers = [('Accept', accept), ('Accept-Encoding', encoding)]
+            response = self.client.get('/api/posts', headers = headers)
+            self.assertEqual(response.status_code, 200)
+            tags[accept, encoding] = etag = response.headers['ETag']
+            
+            response = self.client.get('/api/posts',
+                headers = headers + [('If-None-Match', etag)]
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(set(tags.values())), 4)
+        self.assertTrue(tags['application/msgpack', 'gzip'].endswith('-msgpack-gzip"'))
+        
+        # encoded once, while the listing is unchanged
+        entries = len(encoded_bodies.entries)
+        self.client.get('/api/posts', headers = [('Accept', 'application/msgpack'),
+                                                 ('Accept-Encoding', 'gzip')])
+        self.assertEqual(len(encoded_bodies.entries), entries)
+        
+        # any representation's tag names the version for If-Match
+        response = self.client.get('/api/posts/1',
+            headers = [('Accept', 'application/msgpack')]
+        )
+        self.assertEqual(response.headers['ETag'], '"1-1-msgpack"')
+        data = {'title': 'Changed Title', 'body': 'And changed body.'}
+        response = self.client.put('/api/posts/1', data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json'),
+                       ('If-Match', response.headers['ETag'])]
+        )
+        self.assertEqual(response.status_code, 200)
+        
+    @committed
+    def test_post_write_behind(self):
+        ''' with write-behind on, posts are saved in group commits '''
+        app.config['WRITE_BEHIND'] = True
+        try:
+            data = {'title': 'Example Post', 'body': 'Just a test'}
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+            post = json.loads(response.data.decode('ascii'))
+            self.assertEqual(urlparse(response.headers.get('Location')).path,
+                             '/api/posts/{}'.format(post['id']))
+            
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json'),
+                           ('Prefer', 'respond-async')]
+            )
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.headers['Preference-Applied'], 'respond-async')
+            status_url = urlparse(response.headers['Location']).path
+            
+            for attempt in range(100):
+                response = self.client.get(status_url,
+                    headers = [('Accept', 'application/json')]
+                )
+                status = json.loads(response.data.decode('ascii'))
+                if status['status'] != 'pending':
+                    break
+                time.sleep(0.01)
+        finally:
+            app.config['WRITE_BEHIND'] = False
+        
+        self.assertEqual(status['status'], 'created')
+        self.assertEqual(urlparse(response.headers.get('Location')).path,
+                         '/api/posts/{}'.format(status['id']))
+        self.assertEqual(session.query(models.Post).count(), 2)
+        
+    @committed
+    def test_post_write_behind_receiver_error(self):
+        ''' a failing posts_changed receiver neither loses posts nor the thread '''
+        def receiver(sender, **changes):
+            raise ConnectionError('Change receiver unavailable')
+        app.config['WRITE_BEHIND'] = True
+        signals.posts_changed.connect(receiver)
+        try:
+            data = {'title': 'Example Post', 'body': 'Just a test'}
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+            
+            signals.posts_changed.disconnect(receiver)
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+        finally:
+            signals.posts_changed.disconnect(receiver)
+            app.config['WRITE_BEHIND'] = False
+        self.assertEqual(session.query(models.Post).count(), 2)
+        
+    @committed
+    def test_post_write_behind_dead_thread(self):
+        ''' a dead write-behind thread is restarted, and waits are bounded '''
+        app.config['WRITE_BEHIND'] = True
+        timeout = app.config['WRITE_WAIT_TIMEOUT']
+        data = {'title': 'Example Post', 'body': 'Just a test'}
+        try:
+            # stop the thread, as an unexpected error would
+            self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            writebehind.write_queue.close()
+            self.assertFalse(writebehind.write_queue.thread.is_alive())
+            
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+            
+            # a post not saved in time gets a 503 with its status URL
+            app.config['WRITE_WAIT_TIMEOUT'] = 0
+            response = self.client.post('/api/posts', data = json.dumps(data),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            status_url = urlparse(response.headers['Location']).path
+            ticket = json.loads(response.data.decode('ascii'))['ticket']
+            writebehind.write_queue.ticket(ticket).wait(timeout)
+            response = self.client.get(status_url,
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(json.loads(response.data.decode('ascii'))['status'], 'created')
+        finally:
+            app.config['WRITE_WAIT_TIMEOUT'] = timeout
+            app.config['WRITE_BEHIND'] = False
+        self.assertEqual(session.query(models.Post).count(), 3)
+        
+    def test_metrics(self):
+        ''' request metrics are exported in the Prometheus format '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        session.add(postA)
+        session.commit()
+        
+        self.client.get('/api/posts', headers = [('Accept', 'application/json')])
+        
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        
+        metrics = response.data.decode('ascii')
+        self.assertIn('posts_request_duration_seconds_count'
+                      '{method="GET",route="posts_get"}', metrics)
+        self.assertIn('posts_request_phase_seconds_count'
+                      '{route="posts_get",phase="serialize"}', metrics)
+        self.assertIn('posts_request_rows_bucket{route="posts_get",le="1"}', metrics)
+        
+    # with the snapshot built ahead of the test the listing runs no SQL
+    @committed
+    def test_slow_request_log(self):
+        ''' slow requests are logged with their SQL '''
+        app.config['SLOW_REQUEST_SECONDS'] = 0
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.client.get('/api/posts',
+                    headers = [('Accept', 'application/json')]
+                )
+        finally:
+            app.config['SLOW_REQUEST_SECONDS'] = None
+        
+        self.assertIn('Slow request GET /api/posts', logs.output[0])
+        self.assertIn('FROM posts', logs.output[0])
+        
 if __name__ == "__main__":
     unittest.main()
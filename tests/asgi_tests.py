@@ -0,0 +1,252 @@
+import unittest
+import os
+import json
+import gzip
+import asyncio
+try: from urllib.parse import urlparse
+except ImportError: from urlparse import urlparse # Python 2 compatibility
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import models
+from posts.database import session
+from fixtures import DatabaseTestCase
+
+# the async entry point needs an async database driver
+try:
+    from posts import asgi
+except ImportError:
+    asgi = None
+
+def request(method, path, body = b'', headers = (), sent = None):
+    '''
+    Make a request to the ASGI app, returning status, headers and body.  A
+    list of chunks is sent as a body in several messages, and the messages
+    sent back are collected in sent if given.
+    '''
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'query_string': query.encode('ascii'),
+        'root_path': '',
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 1234)
+    }
+    chunks = body if isinstance(body, list) else [body]
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True}
+                for chunk in chunks]
+    messages[-1]['more_body'] = False
+    sent = [] if sent is None else sent
+    
+    async def receive():
+        return messages.pop(0)
+    
+    async def send(message):
+        sent.append(message)
+    
+    async def run():
+        await asgi.application(scope, receive, send)
+        await asgi.async_engine.dispose()
+    
+    asyncio.run(run())
+    headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                   for name, value in sent[0]['headers'])
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return sent[0]['status'], headers, body
+
+@unittest.skipIf(asgi is None, 'no async database driver installed')
+class TestASGI(DatabaseTestCase):
+    """ Tests for the async entry point """
+    # the async engine has connections of its own
+    committed = True
+        
+    def test_get_posts(self):
+        ''' getting posts from a populated database '''
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        
+        session.add_all([postA, postB])
+        session.commit()
+        
+        for path in ('/api/posts', '/api/posts?stream=true'):
+            status, headers, body = request('GET', path,
+                headers = [('Accept', 'application/json')]
+            )
+            
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'application/json')
+            data = json.loads(body.decode('ascii'))
+            self.assertEqual([post['title'] for post in data],
+                ['Example Post A', 'Example Post B'])
+        
+    def test_count_posts(self):
+        ''' counting posts without listing them '''
+        session.add_all([models.Post(title = 'Example Post A', body = 'Just a test'),
+                         models.Post(title = 'Example Post B', body = 'Still a test')])
+        session.commit()
+        
+        status, headers, body = request('GET', '/api/posts?count=only',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['x-total-count'], '2')
+        self.assertEqual(json.loads(body.decode('ascii')), {'count': 2})
+        
+        status, headers, body = request('HEAD', '/api/posts?title_like=Post+B',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['x-total-count'], '1')
+        self.assertEqual(body, b'')
+        
+    def test_get_posts_compressed(self):
+        ''' streamed listings are gzipped as they are sent '''
+        session.add_all([models.Post(title = 'Example Post {}'.format(i), body = 'x' * 100)
+                         for i in range(20)])
+        session.commit()
+        
+        status, headers, body = request('GET', '/api/posts?stream=true',
+            headers = [('Accept', 'application/json'),
+                       ('Accept-Encoding', 'gzip')]
+        )
+        
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        data = json.loads(gzip.decompress(body).decode('ascii'))
+        self.assertEqual(len(data), 20)
+        
+    def test_get_non_existent_post(self):
+        status, headers, body = request('GET', '/api/posts/1',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(status, 404)
+        data = json.loads(body.decode('ascii'))
+        self.assertEqual(data['message'], 'Could not find post with id 1')
+        
+    def test_unsupported_accept_header(self):
+        status, headers, body = request('GET', '/api/posts',
+            headers = [('Accept', 'application/xml')]
+        )
+        
+        self.assertEqual(status, 406)
+        data = json.loads(body.decode('ascii'))
+        self.assertEqual(data['message'],
+            'Request must accept application/json data')
+        
+    def test_post_unsupported_mimetype(self):
+        status, headers, body = request('POST', '/api/posts',
+            body = b'<xml></xml>',
+            headers = [('Accept', 'application/json'),
+                       ('Content-Type', 'application/xml')]
+        )
+        
+        self.assertEqual(status, 415)
+        
+    def test_post_put_get_delete(self):
+        ''' a post through its whole life cycle '''
+        data = json.dumps({'title': 'Example Post', 'body': 'Just a test'})
+        status, headers, body = request('POST', '/api/posts',
+            body = data.encode('ascii'),
+            headers = [('Accept', 'application/json'),
+                       ('Content-Type', 'application/json')]
+        )
+        
+        self.assertEqual(status, 201)
+        location = urlparse(headers['location']).path
+        self.assertEqual(location, '/api/posts/1')
+        
+        data = json.dumps({'title': 'Changed Title', 'body': 'And changed body.'})
+        status, headers, body = request('PUT', location,
+            body = data.encode('ascii'),
+            headers = [('Accept', 'application/json'),
+                       ('Content-Type', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        etag = headers['etag']
+        
+        data = json.dumps({'body': 'Patched body.'})
+        status, headers, body = request('PATCH', location,
+            body = data.encode('ascii'),
+            headers = [('Accept', 'application/json'),
+                       ('Content-Type', 'application/json'),
+                       ('If-Match', etag)]
+        )
+        self.assertEqual(status, 200)
+        etag = headers['etag']
+        
+        status, headers, body = request('GET', location,
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['etag'], etag)
+        post = json.loads(body.decode('ascii'))
+        self.assertEqual(post['title'], 'Changed Title')
+        self.assertEqual(post['body'], 'Patched body.')
+        
+        status, headers, body = request('DELETE', location,
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+        # every step was logged for clients following the changes
+        status, headers, body = request('GET', '/api/posts/changes?wait=1',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual([change['op'] for change in json.loads(body.decode('ascii'))],
+                         ['create', 'update', 'update', 'delete'])
+
+    def test_wsgi_fallback(self):
+        ''' routes without an async view are served by the WSGI app '''
+        status, headers, body = request('GET', '/api/cache',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(status, 200)
+        self.assertIn('hits', json.loads(body.decode('ascii')))
+        
+    def test_export_import_streamed(self):
+        ''' exports and imports stream through the WSGI app a chunk at a time '''
+        session.add_all([models.Post(title = 'Example Post {}'.format(i), body = 'Just a test')
+                         for i in range(3)])
+        session.commit()
+        
+        chunk_size = app.config['STREAM_CHUNK_SIZE']
+        app.config['STREAM_CHUNK_SIZE'] = 1
+        sent = []
+        try:
+            status, headers, body = request('GET', '/api/posts/_export',
+                headers = [('Accept', 'application/x-ndjson')], sent = sent
+            )
+        finally:
+            app.config['STREAM_CHUNK_SIZE'] = chunk_size
+        self.assertEqual(status, 200)
+        self.assertGreater(len([message for message in sent if message.get('body')]), 1)
+        lines = body.splitlines(keepends = True)
+        self.assertEqual(len(lines), 3)
+        
+        session.query(models.Post).delete()
+        session.commit()
+        
+        # sent in pieces, without a Content-Length
+        status, headers, body = request('POST', '/api/posts/_import',
+            body = [lines[0][:5], lines[0][5:], lines[1], lines[2], b''],
+            headers = [('Accept', 'application/json'),
+                       ('Content-Type', 'application/x-ndjson')]
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('ascii')), {'imported': 3})
+        self.assertEqual(session.query(models.Post).count(), 3)
+        
+if __name__ == "__main__":
+    unittest.main()
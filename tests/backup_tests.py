@@ -0,0 +1,134 @@
+import unittest
+import os
+import json
+import gzip
+import tempfile
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import models
+from posts.database import session
+from fixtures import DatabaseTestCase, clear_tables, reset_state
+
+class TestBackup(DatabaseTestCase):
+    """ Tests for the NDJSON export and import """
+    # the commands read and write through connections of their own
+    committed = True
+
+    def setUp(self):
+        """ Test setup """
+        super().setUp()
+        self.client = app.test_client()
+        self.runner = app.test_cli_runner()
+        
+    def add_posts(self):
+        postA = models.Post(title = 'Example Post A', body = 'Just a test')
+        postB = models.Post(title = 'Example Post B', body = 'Still a test')
+        session.add_all([postA, postB])
+        session.commit()
+        return [postA, postB]
+        
+    def reset(self):
+        session.close()
+        clear_tables()
+        reset_state()
+        
+    def test_export(self):
+        ''' exporting posts as NDJSON '''
+        postA, postB = self.add_posts()
+        ids = [postA.id, postB.id]
+        updated_at = postA.updated_at.isoformat()
+        
+        response = self.client.get('/api/posts/_export',
+            headers = [('Accept', 'application/x-ndjson')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode('utf-8').splitlines()
+        posts = [json.loads(line) for line in lines]
+        self.assertEqual([post['id'] for post in posts], ids)
+        self.assertEqual(posts[0]['title'], 'Example Post A')
+        self.assertEqual(posts[0]['version'], 1)
+        self.assertEqual(posts[0]['updated_at'], updated_at)
+        
+    def test_export_import_gzip(self):
+        ''' a gzipped export loads back into an empty table '''
+        self.add_posts()
+        
+        response = self.client.get('/api/posts/_export',
+            headers = [('Accept', 'application/x-ndjson'),
+                       ('Accept-Encoding', 'gzip')]
+        )
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        data = response.data
+        
+        self.reset()
+        response = self.client.post('/api/posts/_import', data = data,
+            content_type = 'application/x-ndjson',
+            headers = [('Accept', 'application/json'),
+                       ('Content-Encoding', 'gzip')]
+        )
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('ascii')), {'imported': 2})
+        posts = session.query(models.Post).order_by(models.Post.id).all()
+        self.assertEqual([post.title for post in posts],
+                         ['Example Post A', 'Example Post B'])
+        
+        # new posts carry on after the imported ids
+        post = models.Post(title = 'Example Post C', body = 'Another test')
+        session.add(post)
+        session.commit()
+        self.assertEqual(post.id, 3)
+        
+    def test_import_invalid_post(self):
+        ''' one bad line rejects the whole import '''
+        data = '\n'.join([
+            json.dumps({'id': 1, 'title': 'Example Post', 'body': 'Just a test'}),
+            json.dumps({'id': 2, 'title': 'Example Post'})
+        ])
+        
+        response = self.client.post('/api/posts/_import', data = data,
+            content_type = 'application/x-ndjson',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 422)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Line 2: \'body\' is a required property')
+        self.assertEqual(session.query(models.Post).count(), 0)
+        
+    def test_import_existing_ids(self):
+        ''' importing over existing posts is a conflict '''
+        postA, postB = self.add_posts()
+        data = json.dumps({'id': postA.id, 'title': 'Example Post', 'body': 'Just a test'})
+        
+        response = self.client.post('/api/posts/_import', data = data,
+            content_type = 'application/x-ndjson',
+            headers = [('Accept', 'application/json')]
+        )
+        
+        self.assertEqual(response.status_code, 409)
+        
+    def test_cli_export_import(self):
+        ''' the export and import commands round trip through a file '''
+        self.add_posts()
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'posts.ndjson.gz')
+            result = self.runner.invoke(args = ['export', '--gzip', path])
+            self.assertEqual(result.exit_code, 0)
+            with gzip.open(path) as f:
+                self.assertEqual(len(f.read().splitlines()), 2)
+            
+            self.reset()
+            result = self.runner.invoke(args = ['import', path])
+            self.assertEqual(result.exit_code, 0)
+        
+        self.assertEqual(session.query(models.Post).count(), 2)
+        
+if __name__ == "__main__":
+    unittest.main()
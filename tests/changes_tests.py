@@ -0,0 +1,138 @@
+import unittest
+import os
+import json
+import datetime
+import threading
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import changes
+from posts import models
+from posts.database import engine, session
+from fixtures import DatabaseTestCase
+
+class TestChanges(DatabaseTestCase):
+    """ Tests for the change log and GET /api/posts/changes """
+    # waiting requests read the log through connections of their own
+    committed = True
+
+    def setUp(self):
+        """ Test setup """
+        super().setUp()
+        self.client = app.test_client()
+        self.runner = app.test_cli_runner()
+
+    def get_changes(self, query = ''):
+        response = self.client.get('/api/posts/changes' + query,
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('ascii'))
+
+    def test_changes_logged(self):
+        ''' creates, updates and deletes are logged in order '''
+        data = {'title': 'Example Post A', 'body': 'Just a test'}
+        response = self.client.post('/api/posts', data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        id = json.loads(response.data.decode('ascii'))['id']
+
+        data = {'title': 'Example Post A', 'body': 'Updated'}
+        self.client.put('/api/posts/{}'.format(id), data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        self.client.delete('/api/posts/{}'.format(id),
+            headers = [('Accept', 'application/json')]
+        )
+
+        data = self.get_changes()
+        self.assertEqual([change['op'] for change in data],
+                         ['create', 'update', 'delete'])
+        self.assertEqual(data[1], {'seq': data[1]['seq'], 'op': 'update', 'id': id,
+                                   'title': 'Example Post A', 'body': 'Updated'})
+        self.assertEqual(data[2], {'seq': data[2]['seq'], 'op': 'delete', 'id': id})
+
+        # clients ask for what they haven't seen yet
+        data = self.get_changes('?since={}'.format(data[1]['seq']))
+        self.assertEqual([change['op'] for change in data], ['delete'])
+        self.assertEqual(self.get_changes('?since={}&limit=1'.format(data[0]['seq'])), [])
+
+    def test_rolled_back_changes_not_logged(self):
+        ''' only committed changes reach the log '''
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.flush()
+        session.rollback()
+
+        self.assertEqual(self.get_changes(), [])
+
+    def test_long_poll(self):
+        ''' a waiting request returns as soon as a change is committed '''
+        def add_post():
+            with app.app_context():
+                session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+                session.commit()
+
+        timer = threading.Timer(0.05, add_post)
+        timer.start()
+        data = self.get_changes('?wait=5')
+        timer.join()
+
+        self.assertEqual([change['title'] for change in data], ['Example Post A'])
+
+    def test_event_stream(self):
+        ''' changes are pushed as server-sent events '''
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.commit()
+
+        response = self.client.get('/api/posts/changes',
+            headers = [('Accept', 'text/event-stream'), ('Accept-Encoding', 'gzip')]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        event = next(response.response)
+        response.close()
+        lines = event.decode('ascii').splitlines()
+        self.assertEqual(lines[:2], ['id: 1', 'event: create'])
+        data = json.loads(lines[2][len('data: '):])
+        self.assertEqual(data['title'], 'Example Post A')
+
+    def test_invalid_arguments(self):
+        ''' malformed since and wait are rejected '''
+        for query in ('?since=-1', '?since=abc', '?wait=soon', '?wait=-1'):
+            response = self.client.get('/api/posts/changes' + query,
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_prune_changes(self):
+        ''' pruned changes are gone for clients which were behind '''
+        session.add_all([models.Post(title = 'Example Post A', body = 'Just a test'),
+                         models.Post(title = 'Example Post B', body = 'Still a test')])
+        session.commit()
+        session.add(models.Post(title = 'Example Post C', body = 'A test again'))
+        session.commit()
+
+        old = models.utcnow() - datetime.timedelta(days = 30)
+        with engine.begin() as connection:
+            connection.execute(changes.change_log.update().values(changed_at = old))
+
+        result = self.runner.invoke(args = ['prune-changes'])
+        self.assertEqual(result.exit_code, 0)
+        # the newest entry is always kept
+        self.assertEqual(result.output, 'Pruned 2 changes\n')
+
+        response = self.client.get('/api/posts/changes?since=1',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(len(self.get_changes('?since=2')), 1)
+        self.assertEqual(len(self.get_changes()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import unittest
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from sqlalchemy import event, inspect, text
+
+from posts import search
+from posts import snapshot
+from posts.cache import post_cache
+from posts.decorators import encoded_bodies
+from posts.database import Base, engine, session
+
+# Shared setup for the test cases.  The tables are created once per process
+# and each test runs inside a transaction which is rolled back afterwards,
+# so no DDL runs between tests.  Each pytest-xdist worker has a database of
+# its own (see TestingConfig), so the suite can run in parallel:
+#
+#     pytest -n auto
+#
+# Tests which commit through connections of their own (background threads,
+# the async engine, forked servers, CLI commands) can't see a transaction
+# that is never committed.  They are marked with @committed, or set
+# committed on their class, and really commit; their rows are deleted again
+# afterwards.
+
+if engine.dialect.name == 'sqlite':
+    # pysqlite starts transactions itself and gets SAVEPOINT wrong, so let
+    # SQLAlchemy emit BEGIN, as the SQLAlchemy docs recommend
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+schema_created = False
+
+def create_schema():
+    ''' create the tables, from scratch the first time in a process '''
+    global schema_created
+    if schema_created and inspect(engine).has_table('posts'):
+        return
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    schema_created = True
+
+def clear_tables():
+    ''' delete every row and start the ids from 1 again '''
+    tables = Base.metadata.sorted_tables
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('TRUNCATE {} RESTART IDENTITY'.format(
+                ', '.join(table.name for table in tables))))
+            return
+        for table in reversed(tables):
+            connection.execute(table.delete())
+        if inspect(connection).has_table('sqlite_sequence'):
+            connection.execute(text('DELETE FROM sqlite_sequence'))
+
+def reset_state():
+    ''' forget what the process knows about the rows that are gone '''
+    post_cache.clear()
+    encoded_bodies.clear()
+    search.index.reset()
+    snapshot.listing.reset()
+
+def committed(test):
+    ''' run a test against committed data instead of a rolled back transaction '''
+    test.committed = True
+    return test
+
+class DatabaseTestCase(unittest.TestCase):
+    committed = False
+
+    @classmethod
+    def setUpClass(cls):
+        create_schema()
+
+    def setUp(self):
+        """ Test setup """
+        test = getattr(self, self._testMethodName)
+        self.rollback = not getattr(test, 'committed', self.committed)
+        if not self.rollback:
+            return
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        # commits in the app release a savepoint inside the test transaction
+        session.remove()
+        session.configure(bind = self.connection,
+                          join_transaction_mode = 'create_savepoint')
+        # the in-process index and snapshot are built from the empty tables
+        # now and kept current by the commits of the test, which their own
+        # connections would never see
+        search.index.rebuild()
+        snapshot.listing.rebuild()
+
+    def tearDown(self):
+        """ Test teardown """
+        session.remove()
+        if self.rollback:
+            session.configure(bind = engine,
+                              join_transaction_mode = 'conditional_savepoint')
+            self.transaction.rollback()
+            self.connection.close()
+        else:
+            clear_tables()
+        reset_state()
@@ -0,0 +1,76 @@
+import unittest
+import os
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from sqlalchemy import inspect, text
+
+from posts import app
+from posts import migrations
+from posts import models
+from posts.database import Base, engine, session
+import fixtures
+
+class TestMigrations(unittest.TestCase):
+    """ Tests for the schema migrations """
+
+    def setUp(self):
+        """ Test setup """
+        self.runner = app.test_cli_runner()
+        # migrations start from an empty database
+        Base.metadata.drop_all(engine)
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        Base.metadata.drop_all(engine)
+        migrations.schema_version.drop(engine, checkfirst = True)
+        fixtures.reset_state()
+        
+    def columns(self):
+        return set(column['name'] for column in inspect(engine).get_columns('posts'))
+        
+    def test_migrate_empty_database(self):
+        ''' migrating an empty database creates the posts table '''
+        result = self.runner.invoke(args = ['migrate'])
+        
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Applied 1 create_posts', result.output)
+        self.assertEqual(self.columns(), set(['id', 'title', 'body', 'version', 'updated_at']))
+        
+        post = models.Post(title = 'Example Post', body = 'Just a test')
+        session.add(post)
+        session.commit()
+        self.assertEqual(post.version, 1)
+        
+        result = self.runner.invoke(args = ['migrate'])
+        self.assertEqual(result.output, 'Already up to date\n')
+        
+    def test_migrate_in_steps(self):
+        ''' migrations stop at the requested version '''
+        self.assertEqual(migrations.upgrade(target = 1), [1])
+        self.assertEqual(self.columns(), set(['id', 'title', 'body']))
+        
+        applied = migrations.upgrade()
+        self.assertEqual(applied[0], 2)
+        with engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection), applied[-1])
+        
+    def test_migrate_existing_table(self):
+        ''' a table from before the version columns keeps its rows '''
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE posts (id INTEGER PRIMARY KEY, '
+                                    'title VARCHAR(128), body VARCHAR(1024))'))
+            connection.execute(text("INSERT INTO posts (title, body) "
+                                    "VALUES ('Example Post', 'Just a test')"))
+        
+        migrations.upgrade()
+        
+        post = session.get(models.Post, 1)
+        self.assertEqual(post.title, 'Example Post')
+        self.assertEqual(post.version, 1)
+        self.assertIsNotNone(post.updated_at)
+        
+if __name__ == "__main__":
+    unittest.main()
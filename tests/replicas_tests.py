@@ -0,0 +1,112 @@
+import unittest
+import os
+import json
+import tempfile
+import time
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from sqlalchemy import create_engine
+
+from posts import app
+from posts import database
+from posts import models
+from posts.cache import post_cache
+from posts.database import Base, ReplicaRouter, session
+from fixtures import DatabaseTestCase
+
+class TestReplicas(DatabaseTestCase):
+    """ Tests for routing reads to replicas """
+    # a session bound to the test transaction would never be routed
+    committed = True
+
+    def setUp(self):
+        """ Test setup """
+        super().setUp()
+        self.client = app.test_client()
+        
+        # a replica which has not caught up with the primary
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'replica.db')
+        self.replica = create_engine('sqlite:///' + path)
+        Base.metadata.create_all(self.replica)
+        database.router = ReplicaRouter([self.replica], 30)
+
+    def tearDown(self):
+        """ Test teardown """
+        database.router = None
+        super().tearDown()
+        self.replica.dispose()
+        self.directory.cleanup()
+        
+    def get_titles(self):
+        response = self.client.get('/api/posts',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('ascii'))
+        return [post['title'] for post in data]
+        
+    def test_reads_go_to_replica(self):
+        ''' read-only views query the replica '''
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.commit()
+        
+        self.assertEqual(self.get_titles(), [])
+        
+        response = self.client.get('/api/posts/1',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 404)
+        
+    def test_read_your_writes(self):
+        ''' a client which just wrote reads from the primary '''
+        data = {'title': 'Example Post A', 'body': 'Just a test'}
+        response = self.client.post('/api/posts', data = json.dumps(data),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(database.READ_PRIMARY_COOKIE, response.headers['Set-Cookie'])
+        
+        self.assertEqual(self.get_titles(), ['Example Post A'])
+        
+        # other clients still read from the replica
+        self.client = app.test_client()
+        self.assertEqual(self.get_titles(), [])
+        
+    def test_replica_cache_ttl(self):
+        ''' posts read from a replica are cached briefly '''
+        with self.replica.begin() as connection:
+            connection.execute(models.Post.__table__.insert(),
+                               {'title': 'Example Post A', 'body': 'Just a test',
+                                'version': 1, 'updated_at': models.utcnow()})
+        
+        response = self.client.get('/api/posts/1',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 200)
+        key = post_cache.key(1)
+        expires = post_cache.backend.entries[key][1]
+        self.assertLessEqual(expires - time.monotonic(),
+                             app.config['REPLICA_LAG_SECONDS'])
+        
+    def test_failed_replica(self):
+        ''' reads fall back to the primary when replicas are down '''
+        missing = os.path.join(self.directory.name, 'missing', 'replica.db')
+        broken = create_engine('sqlite:///' + missing)
+        router = ReplicaRouter([broken, self.replica], 30)
+        
+        self.assertFalse(router.probe(broken))
+        self.assertEqual([router.choose() for i in range(3)], [self.replica] * 3)
+        
+        # with no healthy replica left the primary serves the request
+        database.router = ReplicaRouter([broken], 30)
+        session.add(models.Post(title = 'Example Post A', body = 'Just a test'))
+        session.commit()
+        self.assertEqual(self.get_titles(), ['Example Post A'])
+        self.assertIn(broken, database.router.down)
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import os
+import json
+import signal
+import time
+from urllib.request import Request, urlopen
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import server
+from posts.cache import post_cache
+from fixtures import DatabaseTestCase
+
+@unittest.skipIf(not hasattr(os, 'fork'), 'the production server needs fork')
+class TestServer(DatabaseTestCase):
+    """ Tests for the pre-forking production server """
+    # the workers are other processes
+    committed = True
+
+    def setUp(self):
+        """ Test setup """
+        super().setUp()
+        
+        sock = server.listen('127.0.0.1', 0, 16)
+        self.port = sock.getsockname()[1]
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                server.Arbiter(app, sock, 2, 5).run()
+            finally:
+                os._exit(0)
+        sock.close()
+
+    def tearDown(self):
+        """ Test teardown """
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        super().tearDown()
+        
+    def get_posts(self):
+        request = Request('http://127.0.0.1:{}/api/posts'.format(self.port),
+                          headers = {'Accept': 'application/json'})
+        for attempt in range(50):
+            try:
+                response = urlopen(request, timeout = 5)
+                break
+            except ConnectionError:
+                time.sleep(0.05)
+        return response.status, json.loads(response.read().decode('ascii'))
+        
+    def test_reload_and_stop(self):
+        ''' workers are replaced on SIGHUP without failing requests '''
+        self.assertEqual(self.get_posts(), (200, []))
+        
+        os.kill(self.pid, signal.SIGHUP)
+        for i in range(10):
+            self.assertEqual(self.get_posts(), (200, []))
+            time.sleep(0.02)
+        
+        os.kill(self.pid, signal.SIGTERM)
+        pid, status = os.waitpid(self.pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        
+class TestLocalCache(unittest.TestCase):
+    """ Tests for worker-local state """
+    
+    def test_local_cache_limited(self):
+        ''' a cache private to each worker keeps entries briefly '''
+        ttl = post_cache.ttl
+        try:
+            server.limit_local_cache(app, 1)
+            self.assertEqual(post_cache.ttl, ttl)
+            with self.assertLogs(app.logger, 'WARNING'):
+                server.limit_local_cache(app, 2)
+            self.assertEqual(post_cache.ttl, app.config['CACHE_LOCAL_TTL'])
+        finally:
+            post_cache.ttl = ttl
+        
+@unittest.skipIf(not hasattr(os, 'fork'), 'the production server needs fork')
+class TestWorkerFailure(unittest.TestCase):
+    """ Tests for workers which fail to start """
+    
+    def test_failing_workers_backoff(self):
+        ''' workers dying as they start are replaced ever more slowly '''
+        class FailingArbiter(server.Arbiter):
+            def serve(self):
+                raise RuntimeError('Cannot start')
+        arbiter = FailingArbiter(app, None, 1)
+        
+        backoffs = []
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            for attempt in range(3):
+                arbiter.spawn()
+                while arbiter.workers:
+                    arbiter.reap()
+                    time.sleep(0.01)
+                backoffs.append(arbiter.backoff)
+        self.assertEqual(backoffs, [0.5, 1, 2])
+        self.assertGreater(arbiter.respawn_at, time.monotonic())
+        self.assertIn('exited with status 1', logs.output[0])
+        
+if __name__ == "__main__":
+    unittest.main()